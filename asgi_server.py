@@ -0,0 +1,544 @@
+"""This module serves the ICGDB web app through ASGI.
+
+License: GPLv3
+Module Description: This module wraps the Flask app of flask_server.py in a
+Starlette app. The read-only JSON endpoints (a game, the games, the genres and
+the publishers) run as coroutines on an async SQLAlchemy engine (aiosqlite for
+SQLite, asyncpg for PostgreSQL), and /gconnect and /gdisconnect call Google's
+OAuth endpoints with an async httpx client. Waiting on a slow client, the
+database or Google therefore does not hold a worker thread. Every other URL is
+passed on to the Flask app, which runs in a thread pool as before and shares
+its session cookie with the async OAuth endpoints.
+
+Usage:
+    $ export ICGDB_SECRET_KEY=<random string>
+    $ uvicorn asgi_server:app --port 5000
+
+Requires the starlette, uvicorn, httpx, a2wsgi and aiosqlite (or asyncpg)
+modules. 'python loadtest_oauth.py' measures the OAuth endpoints against a
+local stub of Google's token endpoint.
+
+For more information regarding the use of SQLAlchemy in this module, please
+visit the SQLAlchemy asyncio documentation.
+"""
+import base64
+import html
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import timezone
+from email.utils import format_datetime
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from werkzeug.http import parse_date, parse_accept_header
+from sqlalchemy import select, tuple_, and_, or_
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import joinedload
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, HTMLResponse, Response, StreamingResponse
+from starlette.routing import Route, Mount
+
+from icgdb_database_setup import Game, Genre, Publisher, User, CatalogVersion
+from icgdb_database_setup import DATABASE_URL, configureSqlite, parsePrice
+from flask_server import app as flask_app, CLIENT_ID, GAMES_JSON_SORT_KEYS
+from flask_server import encodeCursor, decodeCursor, invalidateSuperUsers
+from flask_server import catalogETagFor, etagVariants, compressor, compressBody
+from flask_server import brotli, COMPRESSIBLE_MIMETYPES
+
+# The key signing the session cookie shared by both halves of the app. Unlike
+# flask_server.py's debug server, this entry point has no built-in key.
+if not flask_app.secret_key:
+    flask_app.secret_key = os.environ.get('ICGDB_SECRET_KEY')
+if not flask_app.secret_key:
+    raise RuntimeError('Set the ICGDB_SECRET_KEY environment variable to the '
+                       'key signing the session cookie.')
+
+# ASYNC DATABASE ENGINE
+# DATABASE_URL names the synchronous driver; the async engine connects to the
+# same database through the async driver of its backend.
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+def makeAsyncEngine(url=None, **kwargs):
+    """Returns an AsyncEngine for a database URL (default: DATABASE_URL).
+
+    SQLite connections get the same pragmas as the synchronous engine's.
+    """
+    url = make_url(url or DATABASE_URL)
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS.get(backend, url.drivername))
+    engine = create_async_engine(url, **kwargs)
+    if backend == 'sqlite':
+        configureSqlite(engine.sync_engine)
+    return engine
+
+engine = makeAsyncEngine()
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+# GOOGLE OAUTH CONFIGURATION
+# The token endpoint is read from client_secrets.json like oauth2client does.
+# loadtest_oauth.py points these URLs at a local stub.
+with open('client_secrets.json', 'r') as f:
+    client_secrets = json.load(f)['web']
+GOOGLE_ENDPOINTS = {
+    'token': client_secrets.get('token_uri', 'https://oauth2.googleapis.com/token'),
+    'tokeninfo': 'https://www.googleapis.com/oauth2/v1/tokeninfo',
+    'userinfo': 'https://www.googleapis.com/oauth2/v1/userinfo',
+    'revoke': 'https://accounts.google.com/o/oauth2/revoke',
+}
+OAUTH_TIMEOUT = 10.0 # seconds per request to Google
+OAUTH_MAX_CONNECTIONS = 100 # concurrent connections to Google
+
+
+###  Helper Functions
+
+def queryGames():
+    """Returns a SELECT of Game objects with their genre and publisher loaded."""
+    return select(Game).options(joinedload(Game.genre), joinedload(Game.publisher))
+
+def gameFilters(args):
+    """Returns the SQL conditions selected by a games request's parameters.
+
+    The same parameters as flask_server.gameFilters(); genres and publishers
+    are looked up by name inside the query instead of in a separate one.
+    """
+    conditions = []
+    for key, model, column in (('genre', Genre, Game.genre_id),
+                               ('publisher', Publisher, Game.publisher_id)):
+        if args.get(key):
+            conditions.append(column == select(model.id).where(
+                model.name == args.get(key)).scalar_subquery())
+    try:
+        min_rating = int(args['min_rating']) if 'min_rating' in args else None
+    except ValueError:
+        min_rating = None
+    if min_rating is not None:
+        conditions.append(Game.rating_score >= min_rating)
+    max_price = parsePrice(args.get('max_price'))
+    if max_price is not None:
+        conditions.append(Game.market_price <= max_price)
+    return conditions
+
+def intArg(args, name, default):
+    """Returns an integer query parameter, or default if missing or invalid."""
+    try:
+        return int(args[name])
+    except (KeyError, ValueError):
+        return default
+
+class FlaskJSONResponse(JSONResponse):
+    """A JSON response whose body is byte for byte what Flask's jsonify() sends.
+    
+    Both entry points tag a URL's response with the same strong ETag, so they
+    must send the same bytes: sorted keys, compact separators and a newline.
+    """
+    def render(self, content):
+        return (flask_app.json.dumps(content, separators=(',', ':')) +
+                '\n').encode('utf-8')
+
+def jsonError(message, status):
+    """Returns a JSON {'error': message} response with the given status."""
+    return FlaskJSONResponse({'error': message}, status_code=status)
+
+def jsonMessage(message, status):
+    """Returns a response whose JSON body is a bare message string."""
+    return JSONResponse(message, status_code=status)
+
+catalog_version = {'version': None, 'modified': None, 'expires': 0.0}
+
+async def currentCatalogVersion():
+    """Returns the (version, modified) pair of the catalog.
+
+    Like flask_server.currentCatalogVersion(), the row is read at most once
+    per CATALOG_VERSION_TTL seconds.
+    """
+    if time.time() < catalog_version['expires']:
+        return catalog_version['version'], catalog_version['modified']
+    async with Session() as db:
+        row = (await db.execute(select(CatalogVersion.version,
+                                       CatalogVersion.modified)
+                                .where(CatalogVersion.id == 1))).one()
+    catalog_version['version'] = row.version
+    catalog_version['modified'] = row.modified
+    catalog_version['expires'] = time.time() + flask_app.config['CATALOG_VERSION_TTL']
+    return row.version, row.modified
+
+def conditionalGet(view):
+    """Decorator adding ETag/Last-Modified validators to an async JSON view.
+    
+    Works like flask_server.conditionalGet(): a request whose If-None-Match
+    or If-Modified-Since header matches the current catalog version is
+    answered with '304 Not Modified' before the view runs a query, and the
+    tags are derived by flask_server.catalogETagFor(), so both entry points
+    tag the same URL alike.
+    """
+    async def wrapper(request):
+        login_session = loadFlaskSession(request)
+        if '_flashes' in login_session:
+            return await view(request)
+        
+        version, modified = await currentCatalogVersion()
+        modified = modified.replace(tzinfo=timezone.utc)
+        full_path = '%s?%s' % (request.url.path, request.url.query)
+        etag = '"%s"' % catalogETagFor(version, full_path, login_session)
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match:
+            # compressResponse() suffixes the tags of compressed responses
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            matched = [tag for tag in etagVariants(etag.strip('"'),
+                                                   negotiateEncoding(request))
+                       if '"%s"' % tag in tags or '*' in tags]
+            not_modified = bool(matched)
+            if not_modified:
+                etag = '"%s"' % matched[0]
+        else:
+            since = parse_date(request.headers.get('if-modified-since'))
+            not_modified = since is not None and since >= modified
+        headers = {'ETag': etag,
+                   'Last-Modified': format_datetime(modified, usegmt=True),
+                   'Vary': 'Cookie'}
+        if not_modified:
+            return Response(status_code=304, headers=headers)
+        response = await view(request)
+        if response.status_code == 200:
+            response.headers.update(headers)
+        return response
+    return wrapper
+
+def negotiateEncoding(request):
+    """Returns the best content coding the client accepts, or None."""
+    accepted = parse_accept_header(request.headers.get('accept-encoding'))
+    if brotli is not None and accepted['br'] > 0:
+        return 'br'
+    if accepted['gzip'] > 0:
+        return 'gzip'
+    return None
+
+async def compressStream(chunks, encoding):
+    """Compresses the chunks of a streamed response as they are produced."""
+    compress, flush = compressor(encoding)
+    async for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compress(chunk)
+        if data:
+            yield data
+    yield flush()
+
+def compressResponse(view):
+    """Decorator compressing the responses of an async JSON view.
+    
+    Uses the codings, settings and ETag suffixes of
+    flask_server.compressResponse(), so both entry points send the same
+    bytes and tags.
+    """
+    async def wrapper(request):
+        response = await view(request)
+        if response.media_type not in COMPRESSIBLE_MIMETYPES and \
+                response.status_code != 304:
+            return response
+        response.headers.add_vary_header('Accept-Encoding')
+        if response.status_code != 200 or 'content-encoding' in response.headers:
+            return response
+        encoding = negotiateEncoding(request)
+        if encoding is None:
+            return response
+        
+        if isinstance(response, StreamingResponse):
+            response.body_iterator = compressStream(response.body_iterator,
+                                                    encoding)
+        else:
+            if len(response.body) < flask_app.config['COMPRESS_MIN_SIZE']:
+                return response
+            response.body = compressBody(response.body, encoding)
+            response.headers['content-length'] = str(len(response.body))
+        
+        response.headers['content-encoding'] = encoding
+        etag = response.headers.get('etag')
+        if etag:
+            response.headers['etag'] = '%s-%s"' % (etag[:-1], encoding)
+        return response
+    return wrapper
+
+def loadFlaskSession(request):
+    """Returns the Flask session stored in a request's cookie as a dict."""
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        return dict(serializer.loads(cookie, max_age=int(
+            flask_app.permanent_session_lifetime.total_seconds())))
+    except BadSignature:
+        return {}
+
+def saveFlaskSession(response, login_session):
+    """Writes a session dict to the response's Flask session cookie."""
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    config = flask_app.config
+    response.set_cookie(config['SESSION_COOKIE_NAME'],
+                        serializer.dumps(login_session),
+                        path=config['SESSION_COOKIE_PATH'] or '/',
+                        domain=config['SESSION_COOKIE_DOMAIN'],
+                        secure=config['SESSION_COOKIE_SECURE'],
+                        httponly=config['SESSION_COOKIE_HTTPONLY'],
+                        samesite=config['SESSION_COOKIE_SAMESITE'])
+
+def idTokenClaims(id_token):
+    """Returns the claims of an ID token received from the token endpoint.
+
+    The token comes straight from Google over TLS, so, like oauth2client,
+    its signature is not checked.
+    """
+    payload = id_token.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload.encode('ascii')))
+
+async def exchangeCode(client, code):
+    """Exchanges a one-time authorization code for the user's credentials.
+
+    Returns:
+        The token endpoint's JSON response, with 'access_token' and
+        'id_token', or None if the code was refused.
+    """
+    response = await client.post(GOOGLE_ENDPOINTS['token'], data={
+        'grant_type': 'authorization_code',
+        'code': code,
+        'client_id': CLIENT_ID,
+        'client_secret': client_secrets.get('client_secret', ''),
+        'redirect_uri': 'postmessage',
+    })
+    if response.status_code != 200:
+        return None
+    credentials = response.json()
+    if 'access_token' not in credentials or 'id_token' not in credentials:
+        return None
+    return credentials
+
+
+### BEGIN JSON Endpoints
+
+@compressResponse
+@conditionalGet
+async def gameJSON(request):
+    """Displays a game's information in JSON format."""
+    async with Session() as db:
+        game = (await db.execute(queryGames().where(
+            Game.name == request.path_params['game_name']))).scalar_one_or_none()
+    if game is None:
+        return jsonError('No such game.', 404)
+    return FlaskJSONResponse({'game': game.serialize})
+
+@compressResponse
+@conditionalGet
+async def gamesJSON(request):
+    """Displays the DB's games' information in JSON format.
+
+    Takes the same query parameters as flask_server.gamesJSON(): the filters,
+    'sort', 'limit' and 'after' for keyset pagination, and 'stream'.
+    """
+    args = request.query_params
+    sort = args.get('sort', 'name')
+    if sort not in GAMES_JSON_SORT_KEYS:
+        return jsonError('Unknown sort order.', 400)
+    key = GAMES_JSON_SORT_KEYS[sort]
+    query = queryGames().where(*gameFilters(args))
+    if key is None:
+        query = query.order_by(Game.name, Game.id)
+    else:
+        column, descending = key
+        query = query.where(column.isnot(None)).order_by(
+            column.desc() if descending else column, Game.name, Game.id)
+
+    if args.get('stream') in ('ndjson', 'json'):
+        return streamGames(args.get('stream'), query)
+
+    if 'limit' not in args and 'after' not in args:
+        async with Session() as db:
+            games = (await db.execute(query)).scalars().all()
+        return FlaskJSONResponse({'games': [game.serialize for game in games]})
+
+    limit = intArg(args, 'limit', flask_app.config['JSON_PAGE_SIZE'])
+    limit = max(1, min(limit, flask_app.config['JSON_PAGE_MAX']))
+    if args.get('after'):
+        cursor = decodeCursor(args.get('after'), sort)
+        if cursor is None:
+            return jsonError('Invalid cursor.', 400)
+        after = tuple_(Game.name, Game.id) > tuple_(*cursor[-2:])
+        if key is not None:
+            column, descending = key
+            beyond = column < cursor[0] if descending else column > cursor[0]
+            after = or_(beyond, and_(column == cursor[0], after))
+        query = query.where(after)
+
+    async with Session() as db:
+        games = (await db.execute(query.limit(limit + 1))).scalars().all()
+    next_cursor = None
+    if len(games) > limit:
+        games = games[:limit]
+        next_cursor = encodeCursor(games[-1], sort)
+    return FlaskJSONResponse({'games': [game.serialize for game in games],
+                         'next': next_cursor})
+
+def streamGames(stream_format, query):
+    """Streams the games of an ordered query as NDJSON or one JSON document.
+
+    Rows are fetched from a server-side cursor in batches of
+    JSON_STREAM_BATCH while the client reads the response.
+    """
+    async def generate():
+        separator = ''
+        if stream_format == 'json':
+            yield '{"games": ['
+        async with Session() as db:
+            result = await db.stream(query.execution_options(
+                yield_per=flask_app.config['JSON_STREAM_BATCH']))
+            async for game in result.scalars():
+                if stream_format == 'ndjson':
+                    yield json.dumps(game.serialize) + '\n'
+                else:
+                    yield separator + json.dumps(game.serialize)
+                    separator = ', '
+        if stream_format == 'json':
+            yield ']}'
+
+    if stream_format == 'ndjson':
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+    return StreamingResponse(generate(), media_type='application/json')
+
+@compressResponse
+@conditionalGet
+async def genresJSON(request):
+    """Displays the DB's genres' names and descriptions in JSON format."""
+    async with Session() as db:
+        genres = (await db.execute(select(Genre))).scalars().all()
+    return FlaskJSONResponse({'genres': [genre.serialize for genre in genres]})
+
+@compressResponse
+@conditionalGet
+async def publishersJSON(request):
+    """Displays the DB's publishers' names and descriptions in JSON format."""
+    async with Session() as db:
+        publishers = (await db.execute(select(Publisher))).scalars().all()
+    return FlaskJSONResponse({'publishers': [pub.serialize for pub in publishers]})
+
+#END JSON Endpoints
+
+
+### BEGIN OAUTH Endpoints
+
+async def gconnect(request):
+    """Logs a user in with the one-time code of Google Sign-In. POST
+
+    Does what flask_server.gconnect() does, with every request to Google
+    awaited instead of blocking a thread.
+    """
+    login_session = loadFlaskSession(request)
+    if request.query_params.get('state') is None or \
+            request.query_params.get('state') != login_session.get('state'):
+        return jsonMessage('Invalid state parameter.', 401)
+
+    client = request.app.state.http
+    code = (await request.body()).decode('utf-8')
+    try:
+        credentials = await exchangeCode(client, code)
+    except (httpx.HTTPError, ValueError):
+        credentials = None
+    if credentials is None:
+        return jsonMessage('Failed to upgrade the authorization code.', 401)
+
+    access_token = credentials['access_token']
+    result = (await client.get(GOOGLE_ENDPOINTS['tokeninfo'],
+                               params={'access_token': access_token})).json()
+    if result.get('error') is not None:
+        return jsonMessage(result.get('error'), 500)
+
+    gplus_id = idTokenClaims(credentials['id_token'])['sub']
+    if result['user_id'] != gplus_id:
+        return jsonMessage("Token's user ID doesn't match given user ID.", 401)
+    if result['issued_to'] != CLIENT_ID:
+        return jsonMessage("Token's client ID does not match"
+                           "the app's client ID.", 401)
+
+    if login_session.get('credentials') is not None and \
+            gplus_id == login_session.get('gplus_id'):
+        return jsonMessage('Current user is already connected.', 200)
+
+    data = (await client.get(GOOGLE_ENDPOINTS['userinfo'],
+                             params={'access_token': access_token,
+                                     'alt': 'json'})).json()
+    login_session['access_token'] = access_token
+    login_session['credentials'] = json.dumps(credentials)
+    login_session['gplus_id'] = gplus_id
+    login_session['username'] = data['name']
+    login_session['picture'] = data['picture']
+    login_session['email'] = data['email']
+
+    async with Session() as db:
+        if await db.get(User, data['email']) is None:
+            db.add(User(name=data['name'], email=data['email']))
+            await db.commit()
+            invalidateSuperUsers()
+
+    flashes = list(login_session.get('_flashes', []))
+    flashes.append(('message', 'You are now logged in as %s.' % data['name']))
+    login_session['_flashes'] = flashes
+
+    output = ('<h1>Welcome, %s!</h1><img src="%s " style = "width: 300px; '
+              'height: 300px;border-radius: 150px;-webkit-border-radius: '
+              '150px;-moz-border-radius: 150px;"> '
+              % (html.escape(data['name']), html.escape(data['picture'])))
+    response = HTMLResponse(output)
+    saveFlaskSession(response, login_session)
+    return response
+
+async def gdisconnect(request):
+    """Revokes the logged-in user's token and logs the user out."""
+    login_session = loadFlaskSession(request)
+    if login_session.get('credentials') is None:
+        return jsonMessage('Current user not connected.', 401)
+
+    try:
+        result = await request.app.state.http.get(
+            GOOGLE_ENDPOINTS['revoke'],
+            params={'token': login_session['access_token']})
+    except httpx.HTTPError:
+        result = None
+    if result is None or result.status_code != 200:
+        # for an unknown reason, access token was invalid
+        return jsonMessage('Failed to revoke token for given user.', 400)
+
+    # remove user information from session
+    for key in ('credentials', 'gplus_id', 'username', 'email', 'picture'):
+        login_session.pop(key, None)
+    response = jsonMessage('Successfully disconnected.', 200)
+    saveFlaskSession(response, login_session)
+    return response
+
+#END OAUTH Endpoints
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Opens the shared HTTP client on startup and closes it on shutdown."""
+    app.state.http = httpx.AsyncClient(
+        timeout=OAUTH_TIMEOUT,
+        limits=httpx.Limits(max_connections=OAUTH_MAX_CONNECTIONS))
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        await engine.dispose()
+
+app = Starlette(routes=[
+    Route('/main/games/JSON', gamesJSON),
+    Route('/main/games/{game_name}/JSON', gameJSON),
+    Route('/main/genres/JSON', genresJSON),
+    Route('/main/publishers/JSON', publishersJSON),
+    Route('/gconnect', gconnect, methods=['POST']),
+    Route('/gdisconnect', gdisconnect),
+    Mount('/', app=WSGIMiddleware(flask_app)), # everything else
+], lifespan=lifespan)
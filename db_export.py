@@ -0,0 +1,286 @@
+"""This module exports snapshots of the ICGDB database.
+
+License: GPLv3
+Module Description: This module writes the 'game', 'genre', 'publisher' and
+'user' tables of icgdb.db to gzip-compressed NDJSON or CSV files, or to
+Parquet files if pyarrow is installed. All tables are read inside one read
+transaction, so the files form a consistent snapshot even while the web app
+keeps writing. Rows are streamed from the database in batches and every
+table is split into shards of at most --shard-rows rows, so memory use does
+not grow with the size of the catalog.
+
+Usage:
+    $ python db_export.py
+    $ python db_export.py --format csv --output-dir /backups/icgdb-nightly
+    $ python db_export.py --format parquet --tables games
+
+The output directory holds '<table>-<shard>.<format>[.gz]' files and a
+'manifest.json' listing the files, their row counts and the catalog version
+of the snapshot. Game rows carry their genre and publisher names next to the
+ids, so NDJSON and CSV exports of games, genres and publishers can be loaded
+again with db_import.py.
+
+For more information regarding the use of SQLAlchemy in this module, please
+visit the SQLAlchemy Core documentation.
+"""
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from sqlalchemy import inspect, select, Integer, Numeric, Date, DateTime
+
+from icgdb_database_setup import Game, Genre, Publisher, User, CatalogVersion
+from icgdb_database_setup import DATABASE_URL, makeEngine
+
+# Parquet output is optional
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+SHARD_ROWS = 1000000 # rows per output file
+FETCH_ROWS = 10000 # rows fetched from the database at a time
+FORMATS = {'ndjson': '.ndjson', 'csv': '.csv', 'parquet': '.parquet'}
+
+
+###  Helper Functions
+
+def exportQueries():
+    """Returns {table name: SELECT statement} of the exported tables."""
+    genre = Genre.__table__.alias('genre_ref')
+    publisher = Publisher.__table__.alias('publisher_ref')
+    game = Game.__table__
+    games = select(game, genre.c.name.label('genre'),
+                   publisher.c.name.label('publisher')).select_from(
+        game.outerjoin(genre, game.c.genre_id == genre.c.id)
+            .outerjoin(publisher, game.c.publisher_id == publisher.c.id)
+    ).order_by(game.c.id)
+    return {
+        'games': games,
+        'genres': select(Genre.__table__).order_by(Genre.id),
+        'publishers': select(Publisher.__table__).order_by(Publisher.id),
+        'users': select(User.__table__).order_by(User.email),
+    }
+
+def missingSchema(engine):
+    """Returns the exported tables and columns the database does not have yet.
+    
+    The export only reads, so it never upgrades the database itself.
+    
+    Returns:
+        A list of 'table' and 'table.column' names; empty if none is missing.
+    """
+    inspector = inspect(engine)
+    missing = []
+    for model in (Game, Genre, Publisher, User, CatalogVersion):
+        table = model.__table__
+        if not inspector.has_table(table.name):
+            missing.append(table.name)
+            continue
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        missing.extend('%s.%s' % (table.name, column.name)
+                       for column in table.columns if column.name not in columns)
+    return missing
+
+@contextmanager
+def snapshotConnection(engine):
+    """Yields a Connection whose reads all see the same database snapshot.
+
+    pysqlite does not start a transaction for SELECT statements, so on
+    SQLite the read transaction is opened explicitly. Other databases are
+    read at the REPEATABLE READ isolation level.
+    """
+    with engine.connect() as conn:
+        if conn.dialect.name == 'sqlite':
+            conn.exec_driver_sql('BEGIN')
+        else:
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+
+def jsonValue(value):
+    """Converts dates and decimals for json.dumps()."""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError('%r is not JSON serializable' % value)
+
+def arrowSchema(columns):
+    """Returns the pyarrow schema of a query's columns."""
+    fields = []
+    for column in columns:
+        if isinstance(column.type, Integer):
+            arrow_type = pyarrow.int64()
+        elif isinstance(column.type, Numeric):
+            arrow_type = pyarrow.decimal128(column.type.precision, column.type.scale)
+        elif isinstance(column.type, DateTime):
+            arrow_type = pyarrow.timestamp('s')
+        elif isinstance(column.type, Date):
+            arrow_type = pyarrow.date32()
+        else:
+            arrow_type = pyarrow.string()
+        fields.append(pyarrow.field(column.key, arrow_type))
+    return pyarrow.schema(fields)
+
+
+###  Shard Writers
+
+class ShardWriter(object):
+    """Writes the rows of one table to numbered shard files.
+
+    Attributes:
+        output_dir: the directory the files are written to.
+        table: the exported table's name, used as file name prefix.
+        columns: the names of the exported columns.
+        file_format: a key of FORMATS.
+        compress: whether NDJSON/CSV files are gzip-compressed.
+        shard_rows: the largest number of rows per file.
+        shards: [{'file': name, 'rows': count}] of the files written so far.
+    """
+    def __init__(self, output_dir, table, query, file_format, compress,
+                 shard_rows=SHARD_ROWS):
+        self.output_dir = output_dir
+        self.table = table
+        self.columns = [column.key for column in query.selected_columns]
+        self.schema = arrowSchema(query.selected_columns) \
+            if file_format == 'parquet' else None
+        self.file_format = file_format
+        self.compress = compress and file_format != 'parquet'
+        self.shard_rows = shard_rows
+        self.shards = []
+        self.file = None
+
+    def openShard(self):
+        """Closes the current shard and starts the next one."""
+        self.close()
+        name = '%s-%05d%s' % (self.table, len(self.shards),
+                              FORMATS[self.file_format])
+        if self.compress:
+            name += '.gz'
+        path = os.path.join(self.output_dir, name)
+        if self.file_format == 'parquet':
+            self.file = pyarrow.parquet.ParquetWriter(path, self.schema)
+        elif self.compress:
+            self.file = gzip.open(path, 'wt', compresslevel=6, encoding='utf-8',
+                                  newline='')
+        else:
+            self.file = open(path, 'w', encoding='utf-8', newline='')
+        if self.file_format == 'csv':
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(self.columns)
+        self.shards.append({'file': name, 'rows': 0})
+
+    def write(self, rows):
+        """Writes a batch of rows, starting new shards as they fill up."""
+        while rows:
+            if self.file is None or self.shards[-1]['rows'] >= self.shard_rows:
+                self.openShard()
+            room = self.shard_rows - self.shards[-1]['rows']
+            batch, rows = rows[:room], rows[room:]
+            if self.file_format == 'parquet':
+                self.file.write_table(pyarrow.Table.from_pylist(
+                    [dict(zip(self.columns, row)) for row in batch],
+                    schema=self.schema))
+            elif self.file_format == 'csv':
+                self.csv.writerows(batch)
+            else:
+                self.file.writelines(
+                    json.dumps(dict(zip(self.columns, row)),
+                               default=jsonValue) + '\n'
+                    for row in batch)
+            self.shards[-1]['rows'] += len(batch)
+
+    def close(self):
+        """Closes the current shard file, if any."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def exportTable(conn, output_dir, table, query, file_format, compress,
+                shard_rows):
+    """Streams the rows of a query into shard files.
+
+    Returns:
+        The list of shards written ({'file': name, 'rows': count}).
+    """
+    writer = ShardWriter(output_dir, table, query, file_format, compress,
+                         shard_rows)
+    result = conn.execution_options(stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(FETCH_ROWS)
+            if not rows:
+                break
+            writer.write([tuple(row) for row in rows])
+        if not writer.shards:
+            writer.openShard() # an empty table still gets a (header-only) file
+    finally:
+        writer.close()
+        result.close()
+    return writer.shards
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export a consistent snapshot of the ICGDB tables.')
+    parser.add_argument('--database', default=DATABASE_URL,
+                        help='SQLAlchemy database URL '
+                             '(default: $ICGDB_DATABASE_URL or icgdb.db)')
+    parser.add_argument('--output-dir', default='export',
+                        help='directory the files are written to')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson',
+                        help='output format (parquet requires pyarrow)')
+    parser.add_argument('--tables', nargs='+', choices=sorted(exportQueries()),
+                        default=sorted(exportQueries()),
+                        help='tables to export (default: all)')
+    parser.add_argument('--shard-rows', type=int, default=SHARD_ROWS,
+                        help='largest number of rows per file')
+    parser.add_argument('--no-gzip', dest='compress', action='store_false',
+                        help='write uncompressed NDJSON/CSV files')
+    args = parser.parse_args(argv)
+    if args.format == 'parquet' and pyarrow is None:
+        parser.error('--format parquet requires the pyarrow module')
+
+    engine = makeEngine(args.database)
+    missing = missingSchema(engine)
+    if missing:
+        sys.exit('The database schema is out of date (missing %s); run '
+                 'icgdb_database_setup.py first.' % ', '.join(missing))
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    queries = exportQueries()
+    manifest = {'format': args.format, 'tables': {}}
+    start = time.perf_counter()
+    with snapshotConnection(engine) as conn:
+        version = conn.execute(select(CatalogVersion.version).where(
+            CatalogVersion.id == 1)).scalar()
+        manifest['catalog_version'] = version
+        manifest['exported'] = datetime.utcnow().replace(microsecond=0).isoformat()
+        for table in args.tables:
+            manifest['tables'][table] = exportTable(
+                conn, args.output_dir, table, queries[table], args.format,
+                args.compress, args.shard_rows)
+    elapsed = time.perf_counter() - start
+
+    with open(os.path.join(args.output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    total = sum(shard['rows'] for shards in manifest['tables'].values()
+                for shard in shards)
+    print('Exported %d rows of catalog version %s to %s in %.2fs: %d rows/sec'
+          % (total, version, args.output_dir, elapsed,
+             total / elapsed if elapsed else total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""This module bulk-loads games, genres and publishers into the ICGDB database.
+
+License: GPLv3
+Module Description: This module reads catalog records from CSV files,
+JSON-lines files or the app's own JSON export (/main/games/JSON,
+/main/genres/JSON, /main/publishers/JSON) and inserts them into icgdb.db
+with batched executemany INSERTs in a single transaction. Genres and
+publishers referenced by name are looked up, and created if they do not
+exist yet. Games whose name is already in the database are skipped.
+
+Usage:
+    $ python db_import.py games.csv
+    $ python db_import.py --kind genres genres.jsonl
+    $ python db_import.py genres.json publishers.json games.json.gz
+
+CSV and JSON-lines records use the keys of the JSON export ('name',
+'description', 'genre', 'publisher', 'release_date', 'rating',
+'market_value', 'mv_date', 'pic_url'). 'genre_id'/'publisher_id' may be given
+instead of names. Files ending in '.gz' are decompressed while read.
+
+For more information regarding the use of SQLAlchemy in this module, please
+visit the SQLAlchemy Core documentation.
+"""
+import argparse
+import csv
+import gzip
+import json
+import sys
+import time
+from datetime import date
+from sqlalchemy import insert, select, func, text
+
+from icgdb_database_setup import Game, Genre, Publisher, bumpCatalogVersion
+from icgdb_database_setup import parseRating, parsePrice
+from icgdb_database_setup import gameStatsGroup, updateCatalogStats
+from icgdb_database_setup import SEARCH_KINDS, createSearchTriggers, fillSearchIndex
+from icgdb_database_setup import DATABASE_URL, makeEngine, upgradeDatabase
+
+BATCH_SIZE = 5000 # rows per executemany INSERT
+KINDS = {'games': Game, 'genres': Genre, 'publishers': Publisher}
+GAME_COLUMNS = ('name', 'description', 'rating', 'market_value', 'pic_url',
+                'user_email')
+
+
+###  Helper Functions
+
+def openInput(path):
+    """Opens an input file for reading text, decompressing '.gz' files."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+def detectFormat(path):
+    """Returns 'csv', 'jsonl' or 'json' according to the file's extension."""
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return 'json'
+
+def readRecords(path, file_format, kind):
+    """Yields the (kind, record) pairs stored in an input file.
+
+    Args:
+        path: the input file.
+        file_format: 'csv', 'jsonl' or 'json'.
+        kind: the kind ('games', 'genres' or 'publishers') of the records of
+              CSV and JSON-lines files, and of JSON files holding a list.
+    """
+    with openInput(path) as f:
+        if file_format == 'csv':
+            for row in csv.DictReader(f):
+                yield kind, row
+        elif file_format == 'jsonl':
+            for line in f:
+                if line.strip():
+                    yield kind, json.loads(line)
+        else:
+            data = json.load(f)
+            if isinstance(data, list):
+                data = {kind: data}
+            # genres and publishers first, so games can refer to them
+            for key in ('genres', 'publishers', 'games'):
+                for record in data.get(key, []):
+                    yield key, record
+
+def cleanValue(value):
+    """Returns None for empty values (including the export's 'None')."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value in ('', 'None'):
+        return None
+    return value
+
+def parseDate(value):
+    """Returns the date of a 'YYYY-MM-DD' string, or None if it is empty."""
+    value = cleanValue(value)
+    if value is None:
+        return None
+    return date.fromisoformat(value[:10])
+
+
+###  Import Functions
+
+class Importer(object):
+    """Inserts the records of one or more files inside one transaction.
+
+    Attributes:
+        conn: the Connection of the writing transaction.
+        batch_size: the number of rows per executemany INSERT.
+        user_email: the email recorded as author of new rows, or None.
+        names: {'genres': {name: id}, 'publishers': {name: id}}.
+        game_names: the names of the games in the database.
+        counts: the number of inserted rows per kind, and of 'skipped' records.
+        search_after: {table: the largest id before the import} while the
+                      search index triggers are suspended, else None.
+    """
+    def __init__(self, conn, batch_size=BATCH_SIZE, user_email=None):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.user_email = user_email
+        self.names = {}
+        for kind in ('genres', 'publishers'):
+            table = KINDS[kind].__table__
+            self.names[kind] = dict(conn.execute(select(table.c.name, table.c.id)).all())
+        self.game_names = set(conn.execute(select(Game.name)).scalars())
+        self.counts = {'games': 0, 'genres': 0, 'publishers': 0, 'skipped': 0}
+        self.pending = {'games': [], 'genres': [], 'publishers': []}
+        self.search_after = None
+
+    def suspendSearchSync(self):
+        """Drops the triggers indexing inserted rows for full-text search.
+        
+        resumeSearchSync() indexes the imported rows with one statement per
+        table instead. Both run inside the import's transaction, so the
+        triggers are back if the import fails.
+        """
+        if self.conn.dialect.name != 'sqlite' or self.conn.execute(text(
+                "SELECT name FROM sqlite_master "
+                "WHERE type='table' AND name='search_index'")).first() is None:
+            return
+        self.search_after = {}
+        for table in SEARCH_KINDS:
+            self.conn.execute(text('DROP TRIGGER IF EXISTS %s_search_insert' % table))
+            model = KINDS[table + 's']
+            self.search_after[table] = self.conn.execute(
+                select(func.coalesce(func.max(model.id), -1))).scalar()
+
+    def resumeSearchSync(self):
+        """Indexes the imported rows and recreates the dropped triggers."""
+        if self.search_after is None:
+            return
+        for table, after_id in self.search_after.items():
+            fillSearchIndex(self.conn, table, after_id)
+        createSearchTriggers(self.conn)
+        self.search_after = None
+
+    def add(self, kind, record):
+        """Queues a record for insertion, skipping it if it is invalid."""
+        try:
+            if kind == 'games':
+                row = self.gameRow(record)
+            else:
+                row = self.namedRow(kind, record)
+        except (ValueError, KeyError) as e:
+            print('skipped %s record %r: %s' % (kind, record.get('name'), e),
+                  file=sys.stderr)
+            row = None
+        if row is None:
+            self.counts['skipped'] += 1
+            return
+        self.pending[kind].append(row)
+        if len(self.pending[kind]) >= self.batch_size:
+            self.flush(kind)
+
+    def flush(self, kind):
+        """Inserts the queued rows of a kind with one executemany INSERT.
+
+        The genre and publisher stats are adjusted to the inserted games.
+        """
+        rows = self.pending[kind]
+        if not rows:
+            return
+        table = KINDS[kind].__table__
+        self.conn.execute(insert(table), rows)
+        self.counts[kind] += len(rows)
+        self.pending[kind] = []
+        if kind == 'games':
+            updateCatalogStats(self.conn, added=[gameStatsGroup(row) for row in rows])
+        else:
+            names = [row['name'] for row in rows]
+            self.names[kind].update(self.conn.execute(
+                select(table.c.name, table.c.id).where(table.c.name.in_(names))).all())
+
+    def flushAll(self):
+        """Inserts every queued row, genres and publishers first."""
+        for kind in ('genres', 'publishers', 'games'):
+            self.flush(kind)
+
+    def namedRow(self, kind, record):
+        """Returns the row of a new genre/publisher, or None if it exists."""
+        name = cleanValue(record['name'])
+        if name is None:
+            raise ValueError('no name')
+        if name in self.names[kind] or \
+                any(row['name'] == name for row in self.pending[kind]):
+            return None
+        return {'name': name,
+                'description': cleanValue(record.get('description')) or '',
+                'user_email': self.user_email}
+
+    def resolveId(self, kind, record, key):
+        """Returns the id of the genre/publisher a game record refers to.
+
+        Names take precedence over ids, which differ between databases. A
+        name that is not in the database yet is inserted right away. Games
+        without genre/publisher are filed under 'Other' if it exists.
+        """
+        name = cleanValue(record.get(key))
+        value = cleanValue(record.get(key + '_id'))
+        if name is None and value is not None:
+            return int(value)
+        name = name or 'Other'
+        if name not in self.names[kind]:
+            if name == 'Other':
+                return None
+            self.flush(kind)
+            if name not in self.names[kind]:
+                self.pending[kind].append({'name': name, 'description': '',
+                                           'user_email': self.user_email})
+                self.flush(kind)
+        return self.names[kind][name]
+
+    def gameRow(self, record):
+        """Returns the row of a new game, or None if its name is taken."""
+        name = cleanValue(record['name'])
+        if name is None:
+            raise ValueError('no name')
+        if name in self.game_names:
+            return None
+        row = dict((column, cleanValue(record.get(column)))
+                   for column in GAME_COLUMNS)
+        row['user_email'] = row['user_email'] or self.user_email
+        row['release_date'] = parseDate(record.get('release_date'))
+        row['mv_date'] = parseDate(record.get('mv_date'))
+        row['rating_score'] = parseRating(row['rating'])
+        row['market_price'] = parsePrice(row['market_value'])
+        row['genre_id'] = self.resolveId('genres', record, 'genre')
+        row['publisher_id'] = self.resolveId('publishers', record, 'publisher')
+        self.game_names.add(name)
+        return row
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Bulk-load games, genres and publishers into the ICGDB.')
+    parser.add_argument('paths', nargs='+', metavar='FILE',
+                        help='CSV, JSON-lines or JSON export file (may be .gz)')
+    parser.add_argument('--format', choices=('csv', 'jsonl', 'json'),
+                        help='input format (default: from the file extension)')
+    parser.add_argument('--kind', choices=sorted(KINDS), default='games',
+                        help='kind of the records of CSV/JSON-lines files')
+    parser.add_argument('--database', default=DATABASE_URL,
+                        help='SQLAlchemy database URL '
+                             '(default: $ICGDB_DATABASE_URL or icgdb.db)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='rows per INSERT statement')
+    parser.add_argument('--user-email',
+                        help='email recorded as the author of the new rows')
+    args = parser.parse_args(argv)
+
+    engine = makeEngine(args.database)
+    upgradeDatabase(engine) # the target may be new or from an older version
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        importer = Importer(conn, args.batch_size, args.user_email)
+        importer.suspendSearchSync()
+        for path in args.paths:
+            file_format = args.format or detectFormat(path)
+            for kind, record in readRecords(path, file_format, args.kind):
+                importer.add(kind, record)
+        importer.flushAll()
+        importer.resumeSearchSync()
+        bumpCatalogVersion(conn)
+    elapsed = time.perf_counter() - start
+
+    counts = importer.counts
+    total = counts['games'] + counts['genres'] + counts['publishers']
+    print('Imported %d games, %d genres and %d publishers (%d skipped) '
+          'in %.2fs: %d rows/sec' % (counts['games'], counts['genres'],
+          counts['publishers'], counts['skipped'], elapsed,
+          total / elapsed if elapsed else total))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-"""This module populates the sqlite DB for the ICGDB web app.
+"""This module populates the DB for the ICGDB web app.
 
 License: GPLv3
 Module Description: This module populates the icgdb.db with games,
@@ -11,12 +11,14 @@ This package was created to satisfy the Udacity Full Stack Nanodegree
 requirement for the Catalog project.
 """
 from datetime import datetime
-from sqlalchemy import create_engine
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker
 
-from icgdb_database_setup import Base, Genre, Game, Publisher, User
+from icgdb_database_setup import Base, Genre, Game, Publisher, User, makeEngine
+from icgdb_database_setup import upgradeDatabase
 
-engine = create_engine('sqlite:///icgdb.db')
+engine = makeEngine()
+upgradeDatabase(engine)
 Base.metadata.bind = engine
 DBSession = sessionmaker(bind=engine)
 session = DBSession()
@@ -25,6 +27,9 @@ session = DBSession()
 text_1 = 'Sed ut perspiciatis unde omnis iste natus error sit voluptatem accusantium doloremque laudantium, totam rem aperiam, eaque ipsa quae ab illo inventore veritatis et quasi architecto beatae vitae dicta sunt explicabo. Nemo enim ipsam voluptatem quia voluptas sit aspernatur aut odit aut fugit, sed quia consequuntur magni dolores eos qui ratione voluptatem sequi nesciunt. Neque porro quisquam est, qui dolorem ipsum quia dolor sit amet, consectetur, adipisci velit, sed quia non numquam eius modi tempora incidunt ut labore et dolore magnam aliquam quaerat voluptatem. Ut enim ad minima veniam, quis nostrum exercitationem ullam corporis suscipit laboriosam, nisi ut aliquid ex ea commodi consequatur? Quis autem vel eum iure reprehenderit qui in ea voluptate velit esse quam nihil molestiae consequatur, vel illum qui dolorem eum fugiat quo voluptas nulla pariatur?'
 text_2 ='At vero eos et accusamus et iusto odio dignissimos ducimus qui blanditiis praesentium voluptatum deleniti atque corrupti quos dolores et quas molestias excepturi sint occaecati cupiditate non provident, similique sunt in culpa qui officia deserunt mollitia animi, id est laborum et dolorum fuga. Et harum quidem rerum facilis est et expedita distinctio. Nam libero tempore, cum soluta nobis est eligendi optio cumque nihil impedit quo minus id quod maxime placeat facere possimus, omnis voluptas assumenda est, omnis dolor repellendus.'
 
+# descriptions hold up to 500 characters; server databases enforce the limit
+text_1, text_2 = text_1[:500], text_2[:500]
+
 # Create a user in the User table.
 # For the ability to add/edit/delete data from the database regardless of who
 # entered the data, set the user to a superuser by setting "privilege='superuser'"
@@ -41,7 +46,7 @@ genres = [['RTS',1, text_1], ['RPG',2, text_2], ['FPS',3, text_2],
 for genre in genres:
     newGenre = Genre(name=genre[0], id=genre[1], description=genre[2])
     session.add(newGenre)
-    session.commit()
+session.commit()
 
 # Make a list containing publisher names, descriptions, and ids
 publishers = [
@@ -101,7 +106,15 @@ publishers = [
 for pub_info in publishers:
   newPublisher = Publisher(name=pub_info['name'], id=pub_info['id'], description=pub_info['description'])
   session.add(newPublisher)
-  session.commit()
+session.commit()
+
+# Genres and publishers were given explicit ids. Server databases hand out
+# new ids from sequences, which must be moved past the ids used here.
+if engine.dialect.name == 'postgresql':
+    for table in ('genre', 'publisher'):
+        session.execute(text("SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                             "(SELECT max(id) FROM %s))" % table), {'table': table})
+    session.commit()
   
 # Make a list containing game names, descriptions, etc
 games = [
@@ -257,24 +270,14 @@ for game in games:
     rd = datetime(int(rd[0]),int(rd[1]),int(rd[2]))
     md = game['mv_date'].split('-')
     md = datetime(int(md[0]),int(md[1]),int(md[2]))
-    
-    for x in genres:
-        if x[1]==game['genre_id']:
-            genre_name=x[0]
-            break
-  
-    for y in publishers:
-        if y['id']==game['publisher_id']:
-            publisher_name=y['name']
-            break
 
     newGame = Game(
-        name=game['name'], genre_name=genre_name, release_date=rd,
-        publisher_name=publisher_name, rating=game['rating'],
+        name=game['name'], genre_id=game['genre_id'], release_date=rd,
+        publisher_id=game['publisher_id'], rating=game['rating'],
         description=game['description'], market_value=game['market_value'],
         mv_date=md, pic_url=game['pic_url'])
     session.add(newGame)
-    session.commit()
+session.commit()
 
   
 print('Reached end of file! Database successfully populated!')
\ No newline at end of file
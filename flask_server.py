@@ -25,13 +25,27 @@ requirement for the Catalog project.
 """
 
 import os
-from datetime import datetime
+import base64
+import threading
+import time
+import hashlib
+import tempfile
+import functools
+from collections import OrderedDict
+from datetime import datetime, timezone
+from decimal import Decimal
 from flask import Flask, render_template, url_for, request, redirect, flash, jsonify
+from flask import Response, stream_with_context
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import tuple_, event, false, literal, and_, or_, union_all, case
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker, scoped_session, joinedload
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import text
-from icgdb_database_setup import Base, Game, Publisher, Genre, User
+from icgdb_database_setup import Base, Game, Publisher, Genre, User, CatalogVersion
+from icgdb_database_setup import GenreStats, PublisherStats, GenrePublisherStats
+from icgdb_database_setup import gameStatsGroups, updateCatalogStats, dropCatalogStats
+from icgdb_database_setup import DATABASE_URL, makeEngine, parsePrice
 
 # Oauth Imports
 import random, string
@@ -45,24 +59,389 @@ import requests
 
 # Security Imports
 import bleach # to sanitize user text input
-from werkzeug.utils import secure_filename # to sanitize user file upload
 from flask_seasurf import SeaSurf
 
+# Image processing import (optional: without Pillow no thumbnails are made)
+try:
+    from PIL import Image, features
+    WEBP_SUPPORTED = features.check('webp')
+except ImportError:
+    Image = None
+    WEBP_SUPPORTED = False
+
 # XML endpoint import
-import xml.etree.ElementTree as ET
+import re
+from xml.sax.saxutils import escape, quoteattr
+
+# Static asset and compression imports (optional: without brotli only gzip is
+# used)
+import gzip
+import zlib
+import mimetypes
+from flask import send_from_directory, g
+from werkzeug.security import safe_join
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 csrf = SeaSurf(app)
 
 ### END IMPORTS
 
+# DATABASE CONNECTION POOL CONFIGURATION
+# These settings may be overridden per deployment via environment variables.
+# DATABASE_URL comes from ICGDB_DATABASE_URL (see icgdb_database_setup).
+app.config['DATABASE_URL'] = DATABASE_URL
+app.config['DB_POOL_SIZE'] = int(os.environ.get('ICGDB_DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('ICGDB_DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('ICGDB_DB_POOL_RECYCLE', 3600))
+
 # Connect to db
-engine = create_engine('sqlite:///icgdb.db')
+engine = makeEngine(app.config['DATABASE_URL'],
+                    poolclass=QueuePool,
+                    pool_size=app.config['DB_POOL_SIZE'],
+                    max_overflow=app.config['DB_MAX_OVERFLOW'],
+                    pool_recycle=app.config['DB_POOL_RECYCLE'])
 Base.metadata.bind = engine
 
 DBSession = sessionmaker(bind=engine)
-session = DBSession()
 
+# 'session' is a registry of sessions, one per request (thread). A session is
+# opened lazily the first time a view uses it and is closed by
+# shutdownSession() when the request ends, returning its connection to the pool.
+session = scoped_session(DBSession)
+
+
+@app.teardown_appcontext
+def shutdownSession(exception=None):
+    """Ends the current request's DB session.
+
+    Views commit their changes explicitly, so anything still pending here
+    belongs to a request that failed or bailed out early and is rolled back.
+    The session's connection is then released back to the pool so that a
+    failed request cannot affect later requests.
+    """
+    try:
+        session.rollback()
+    finally:
+        session.remove()
+
+
+# characters that may not appear anywhere in an XML 1.0 document
+XML_INVALID_CHARS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# JSON API PAGINATION CONFIGURATION
+app.config['JSON_PAGE_SIZE'] = 100 # default page size when 'limit' is omitted
+app.config['JSON_PAGE_MAX'] = 1000 # largest page a client may request
+app.config['JSON_STREAM_BATCH'] = 500 # rows fetched per round trip when streaming
+# sort parameter of /main/games/JSON -> (key column, descending) or None; games
+# are ordered by the key column, then by (name, id). With a key column, games
+# that have no value for it are left out, so the key can be used as a cursor.
+GAMES_JSON_SORT_KEYS = {
+    'name': None,
+    'rating': (Game.rating_score, True),
+    'price': (Game.market_price, False),
+}
+
+# NAME LIST CACHE
+# The sorted lists of genre and publisher names are read on most pages but only
+# change when a genre/publisher is created, renamed or deleted, so they are
+# cached in-process. Each entry is keyed by the catalog version it was read at,
+# so changes made by other workers or scripts are picked up like in the page
+# cache. See listNames() and invalidateNames().
+CACHED_NAME_CLASSES = (Genre, Publisher)
+name_cache = {}
+name_cache_lock = threading.Lock()
+name_cache_stats = {'hits': 0, 'misses': 0}
+
+# AUTHORIZATION CACHE
+# The set of superuser emails is consulted on every change request. It is
+# cached for SUPERUSER_CACHE_TTL seconds and invalidated when users are created
+# or their privilege changes. See listSuperUsers() and isSuperUser().
+app.config['SUPERUSER_CACHE_TTL'] = 60
+superuser_cache = {'emails': frozenset(), 'expires': 0.0}
+superuser_cache_lock = threading.Lock()
+superuser_cache_stats = {'hits': 0, 'misses': 0}
+
+# HTTP CACHE VALIDATION
+# Read-only pages and endpoints are tagged with an ETag and Last-Modified date
+# derived from the catalog version, which every committed change increments
+# (see icgdb_database_setup.CatalogVersion). Each worker re-reads the version
+# at most once per CATALOG_VERSION_TTL seconds, and right after it committed a
+# change itself.
+app.config['CATALOG_VERSION_TTL'] = 1.0
+catalog_version = {'version': None, 'modified': None, 'expires': 0.0}
+catalog_version_lock = threading.Lock()
+
+@event.listens_for(DBSession, 'after_commit')
+def expireCatalogVersion(db_session):
+    """Makes this worker re-read the catalog version after its own change."""
+    if db_session.info.pop('catalog_bumped', False):
+        with catalog_version_lock:
+            catalog_version['expires'] = 0.0
+        clearPageCache()
+
+def currentCatalogVersion():
+    """Returns the (version, modified) pair of the catalog."""
+    with catalog_version_lock:
+        if time.time() < catalog_version['expires']:
+            return catalog_version['version'], catalog_version['modified']
+    
+    row = session.query(CatalogVersion.version, CatalogVersion.modified).filter(
+        CatalogVersion.id == 1).one()
+    modified = row.modified.replace(tzinfo=timezone.utc)
+    with catalog_version_lock:
+        catalog_version['version'] = row.version
+        catalog_version['modified'] = modified
+        catalog_version['expires'] = time.time() + app.config['CATALOG_VERSION_TTL']
+    return row.version, modified
+
+def catalogETag(version):
+    """Returns the strong ETag of the current request's response."""
+    return catalogETagFor(version, request.full_path, login_session)
+
+def catalogETagFor(version, full_path, session_values):
+    """Returns the strong ETag of a response to a read-only request.
+    
+    The tag covers the catalog version, the requested URL (including its
+    query string) and, for logged-in users, the session values rendered into
+    their pages. asgi_server.py tags its responses with this function too.
+    
+    Args:
+        version: the catalog version.
+        full_path: the path and query string, as in Flask's request.full_path
+                   (always with a '?').
+        session_values: the requesting user's login_session (a mapping).
+    """
+    key = '%s|%s' % (version, full_path)
+    if 'username' in session_values:
+        key += '|%s|%s|%s' % (session_values.get('email'),
+                              session_values.get('state'),
+                              session_values.get('_csrf_token'))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def conditionalGet(view):
+    """Decorator adding ETag/Last-Modified validators to a read-only view.
+    
+    A GET request whose If-None-Match or If-Modified-Since header matches the
+    current catalog version is answered with '304 Not Modified' before the
+    view runs any query or renders any template. Requests with pending flash
+    messages are passed through because their page shows one-time content.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or '_flashes' in login_session:
+            return view(*args, **kwargs)
+        
+        version, modified = currentCatalogVersion()
+        etag = catalogETag(version)
+        if request.if_none_match:
+            # compressResponse() suffixes the tags of compressed responses
+            matched = [tag for tag in etagVariants(etag, negotiateEncoding())
+                       if request.if_none_match.contains(tag)]
+            not_modified = bool(matched)
+            if not_modified:
+                etag = matched[0]
+        else:
+            not_modified = (request.if_modified_since is not None and
+                            request.if_modified_since >= modified)
+        if not_modified:
+            # has no mimetype, so compressResponse() does not add this
+            response = Response(status=304)
+            response.vary.add('Accept-Encoding')
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        
+        response.set_etag(etag)
+        response.last_modified = modified
+        response.vary.add('Cookie')
+        return response
+    return wrapper
+
+# RENDERED PAGE CACHE
+# The public (logged-out) versions of the game list, genre and publisher pages
+# are the same for every anonymous visitor, so their rendered HTML is kept in
+# an LRU cache keyed by URL and catalog version. Local commits clear the cache;
+# changes made by other workers are picked up through the catalog version.
+app.config['PAGE_CACHE_SIZE'] = 256 # number of rendered pages kept
+page_cache = OrderedDict()
+page_cache_lock = threading.Lock()
+page_cache_stats = {'hits': 0, 'misses': 0}
+
+def clearPageCache():
+    """Drops every cached page after the catalog changed."""
+    with page_cache_lock:
+        page_cache.clear()
+
+def cachedPage(view):
+    """Decorator serving the anonymous version of a page from page_cache.
+    
+    Logged-in users (whose nav bar and buttons differ), non-GET requests and
+    requests with pending flash messages always run the view.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if (request.method != 'GET' or 'username' in login_session or
+                '_flashes' in login_session):
+            return view(*args, **kwargs)
+        
+        key = (request.endpoint, request.full_path, currentCatalogVersion()[0])
+        with page_cache_lock:
+            cached = page_cache.get(key)
+            if cached is not None:
+                page_cache.move_to_end(key)
+                page_cache_stats['hits'] += 1
+        if cached is not None:
+            g.compressed_variants = cached[2]
+            return Response(cached[0], mimetype=cached[1])
+        
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            # compressResponse() stores the compressed bodies in the entry
+            g.compressed_variants = {}
+            with page_cache_lock:
+                page_cache_stats['misses'] += 1
+                page_cache[key] = (response.get_data(), response.mimetype,
+                                   g.compressed_variants)
+                while len(page_cache) > app.config['PAGE_CACHE_SIZE']:
+                    page_cache.popitem(last=False)
+        return response
+    return wrapper
+
+# RESPONSE COMPRESSION
+# Text responses of at least COMPRESS_MIN_SIZE bytes are sent Brotli (if the
+# brotli module is installed) or gzip compressed when the client accepts it.
+# Streamed responses are compressed as they are sent. The compressed bodies of
+# cached pages are kept with the page, so each is only compressed once.
+app.config['COMPRESS_MIN_SIZE'] = 1024 # bytes
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+COMPRESSIBLE_MIMETYPES = frozenset([
+    'text/html', 'text/css', 'text/plain', 'text/xml', 'application/xml',
+    'application/json', 'application/x-ndjson', 'application/javascript'])
+
+def etagVariants(etag, encoding):
+    """Returns the ETags of the representations a client may be sent.
+    
+    These are the uncompressed one (small responses are not compressed) and,
+    if encoding is not None, the one compressed with that coding. Tags of
+    codings the client did not ask for must never earn it a '304'.
+    
+    Args:
+        etag: the ETag of the uncompressed response.
+        encoding: the coding negotiateEncoding() chose for the request.
+    """
+    if encoding is None:
+        return [etag]
+    return [etag, '%s-%s' % (etag, encoding)]
+
+def negotiateEncoding():
+    """Returns the best content coding the client accepts, or None."""
+    if brotli is not None and request.accept_encodings['br'] > 0:
+        return 'br'
+    if request.accept_encodings['gzip'] > 0:
+        return 'gzip'
+    return None
+
+def compressor(encoding):
+    """Returns (compress, flush) functions of a new streaming compressor."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(app.config['COMPRESS_GZIP_LEVEL'],
+                                  zlib.DEFLATED, 31) # 31: with gzip header
+    return compressor.compress, compressor.flush
+
+def compressBody(data, encoding):
+    """Returns the data compressed with the given content coding."""
+    compress, flush = compressor(encoding)
+    return compress(data) + flush()
+
+def compressStream(chunks, encoding):
+    """Compresses the chunks of a streamed response as they are produced."""
+    compress, flush = compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compress(chunk)
+            if data:
+                yield data
+        yield flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+@app.after_request
+def compressResponse(response):
+    """Compresses text responses for clients that accept it.
+    
+    The ETag of a compressed response gets the coding as suffix, so it never
+    matches the uncompressed representation. Responses that are already
+    encoded or sent from a file are left alone.
+    """
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough or
+            'Content-Encoding' in response.headers):
+        return response
+    encoding = negotiateEncoding()
+    if encoding is None:
+        return response
+    
+    if response.is_streamed:
+        response.response = compressStream(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        variants = g.get('compressed_variants')
+        if variants is None:
+            response.set_data(compressBody(data, encoding))
+        else:
+            if encoding not in variants:
+                variants[encoding] = compressBody(data, encoding)
+            response.set_data(variants[encoding])
+    
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag('%s-%s' % (etag, encoding), weak)
+    return response
+
+# GAME LIST CONFIGURATION
+app.config['GAMES_PAGE_SIZE'] = 50 # games per page of the games list
+# sort parameter -> (label shown in the drop-down, ORDER BY clauses)
+GAMES_SORT_ORDERS = OrderedDict([
+    ('name', ('Name', (Game.name,))),
+    ('newest', ('Newest', (Game.release_date.desc(), Game.name))),
+    ('oldest', ('Oldest', (Game.release_date, Game.name))),
+    ('rating', ('Top rated', (Game.rating_score.desc().nulls_last(), Game.name))),
+    ('price', ('Cheapest', (Game.market_price.asc().nulls_last(), Game.name))),
+])
+
+# GENRE/PUBLISHER DELETION
+# The games of a deleted genre/publisher are moved to "Other" this many at a
+# time, each batch in its own short transaction (see repointGames()).
+app.config['CASCADE_BATCH_SIZE'] = 1000
+
+# BULK EDIT API CONFIGURATION
+app.config['BULK_MAX_ITEMS'] = 10000 # names per bulk request
+BULK_CHUNK_SIZE = 500 # names per IN (...) list, below every DB's parameter limit
+BULK_KINDS = {'games': Game, 'genres': Genre, 'publishers': Publisher}
+
+# GENRE/PUBLISHER STATISTICS
+# class -> (its stats class, the class it is paired with, key of the paired names)
+STATS_KINDS = {Genre: (GenreStats, Publisher, 'publishers'),
+               Publisher: (PublisherStats, Genre, 'genres')}
+
+# SEARCH CONFIGURATION
+app.config['SEARCH_PAGE_SIZE'] = 20 # results per search page
 
 # SETUP AND CONFIGURATION FOR FILE(IMAGE) UPLOAD
 UPLOAD_FOLDER = os.path.abspath('static/pics')
@@ -73,13 +452,305 @@ app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 # limit size to 100kb
 def checkExtension(filename):
     return '.' in filename and filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
 
+# Uploads are stored under the hash of their content ('<hash>.png'), so an
+# identical picture uploaded twice is stored once and a stored file never
+# changes. Derivatives are stored next to the upload: the 'thumb' JPEG of
+# '<hash>.png' is '<hash>.thumb.jpg' and its WebP version '<hash>.thumb.webp'.
+# A stored picture is deleted with its derivatives once no game uses it.
+HASHED_PIC = re.compile(r'^[0-9a-f]{32}\.[a-z]+$')
+app.config['PIC_GC_GRACE'] = 60 # seconds a re-uploaded picture is kept unused
+# size name -> the largest width/height in pixels
+IMAGE_SIZES = OrderedDict([('thumb', 160), ('medium', 480)])
+app.config['IMAGE_QUALITY'] = 80 # JPEG and WebP quality of the derivatives
+# Uploads are at most 100kb, but a compressed image can decode to hundreds of
+# MB. Larger images are rejected before their pixels are decoded.
+app.config['IMAGE_MAX_PIXELS'] = 4000000
+if Image is not None:
+    Image.MAX_IMAGE_PIXELS = app.config['IMAGE_MAX_PIXELS']
+
 def uploadFile():
+    """Stores the uploaded game picture and returns its file name.
+    
+    The upload is streamed to a temporary file while it is hashed, then moved
+    to '<hash>.<extension>'. If that file already exists the copy is dropped.
+    Returns None if no picture was stored, e.g. because makeDerivatives()
+    rejected it.
+    """
     file = request.files['game-image']
     if file and checkExtension(file.filename):
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        folder = app.config['UPLOAD_FOLDER']
+        # checked by checkExtension(), so safe to use in a path
+        extension = file.filename.rsplit('.', 1)[1].lower()
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=folder, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+                    digest.update(chunk)
+                    temp.write(chunk)
+            
+            filename = '%s.%s' % (digest.hexdigest()[:32], extension)
+            path = os.path.join(folder, filename)
+            if os.path.exists(path):
+                # identical picture already stored; mark it as in use so that
+                # releasePicture() does not collect it before this game is saved
+                os.remove(temp_path)
+                os.utime(path, None)
+            else:
+                os.replace(temp_path, path)
+                if not makeDerivatives(filename):
+                    os.remove(path)
+                    flash('The picture is unreadable or too large and was not saved.')
+                    return None
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
         return filename
 
+def releasePicture(filename):
+    """Deletes a stored picture and its derivatives if no game uses it anymore.
+    
+    Must be called after the change that stopped using the picture was
+    committed. Only content-addressed uploads are deleted, never the pictures
+    shipped in static/pics, and not within PIC_GC_GRACE seconds of an upload.
+    """
+    if not filename or not HASHED_PIC.match(filename):
+        return
+    if session.query(Game.id).filter(Game.pic_url == filename).first() is not None:
+        return
+    
+    folder = app.config['UPLOAD_FOLDER']
+    path = os.path.join(folder, filename)
+    try:
+        if time.time() - os.path.getmtime(path) < app.config['PIC_GC_GRACE']:
+            return
+    except OSError:
+        return
+    stem = filename.rsplit('.', 1)[0]
+    for name in [filename] + ['%s.%s.%s' % (stem, size, image_format)
+                              for size in IMAGE_SIZES
+                              for image_format in ('jpg', 'webp')]:
+        try:
+            os.remove(os.path.join(folder, name))
+        except OSError:
+            pass
+
+def makeDerivatives(filename):
+    """Writes the resized JPEG and WebP versions of an uploaded picture.
+    
+    Requires Pillow. Without it no derivatives are written and pages fall
+    back to the original file.
+    
+    Returns:
+        False if the upload is not a readable image or has more than
+        IMAGE_MAX_PIXELS pixels, True otherwise.
+    """
+    if Image is None:
+        return True
+    folder = app.config['UPLOAD_FOLDER']
+    stem = filename.rsplit('.', 1)[0]
+    original = None
+    try:
+        original = Image.open(os.path.join(folder, filename))
+        width, height = original.size # read from the header, nothing decoded
+        if width * height > app.config['IMAGE_MAX_PIXELS']:
+            original.close()
+            return False
+        original.load()
+    except (IOError, SyntaxError, Image.DecompressionBombError):
+        if original is not None:
+            original.close()
+        return False
+    if original.mode not in ('RGB', 'L'):
+        # flatten transparency onto white, since JPEG has no alpha channel
+        background = Image.new('RGB', original.size, (255, 255, 255))
+        original = original.convert('RGBA')
+        background.paste(original, mask=original.split()[3])
+        original = background
+    
+    quality = app.config['IMAGE_QUALITY']
+    for size_name, size in IMAGE_SIZES.items():
+        image = original.copy()
+        image.thumbnail((size, size), Image.LANCZOS)
+        image.save(os.path.join(folder, '%s.%s.jpg' % (stem, size_name)),
+                   'JPEG', quality=quality, optimize=True, progressive=True)
+        if WEBP_SUPPORTED:
+            image.save(os.path.join(folder, '%s.%s.webp' % (stem, size_name)),
+                       'WEBP', quality=quality)
+    return True
+
+@app.template_global()
+def picUrl(pic_url, size=None):
+    """Returns the URL of a game's picture for use in templates.
+    
+    Args:
+        pic_url: the game's pic_url, may be empty.
+        size: a key of IMAGE_SIZES for a resized JPEG, or None for the
+              original. Falls back to the original if the derivative is missing.
+    """
+    if not pic_url:
+        return url_for('static', filename='pics/placeholder.png')
+    if size:
+        derivative_url = derivativeUrl(pic_url, size)
+        if derivative_url:
+            return derivative_url
+    return url_for('static', filename='pics/' + pic_url)
+
+@app.template_global()
+def derivativeUrl(pic_url, size, image_format='jpg'):
+    """Returns the URL of a resized game picture, or None if it was not made.
+    
+    Args:
+        pic_url: the game's pic_url, may be empty.
+        size: a key of IMAGE_SIZES.
+        image_format: 'jpg' or 'webp'.
+    """
+    if not pic_url:
+        return None
+    derivative = '%s.%s.%s' % (pic_url.rsplit('.', 1)[0], size, image_format)
+    if os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], derivative)):
+        return url_for('static', filename='pics/' + derivative)
+    return None
+
+
+# STATIC ASSETS
+# Every URL built with url_for('static', ...) carries the hash of the file's
+# content ('style_base.css?v=<hash>'). A request whose hash matches the file is
+# answered with a far-future immutable Cache-Control, so browsers never
+# revalidate it; when the file changes so does its URL. Text assets are also
+# stored gzip (and brotli) compressed next to the original at startup.
+app.config['STATIC_IMMUTABLE_MAX_AGE'] = 31536000 # one year
+PRECOMPRESSED_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.json', '.xml')
+PRECOMPRESSED_ENCODINGS = (('br', '.br'), ('gzip', '.gz')) # preferred first
+# file name relative to the static folder -> ((mtime, size), content hash)
+asset_manifest = {}
+
+def assetVersion(filename):
+    """Returns the content hash of a static file, or None if it does not exist.
+    
+    Hashes are kept in asset_manifest and recomputed when the file's
+    modification time or size changes.
+    
+    Args:
+        filename: the file's path relative to the static folder.
+    """
+    path = safe_join(app.static_folder, filename)
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+    entry = asset_manifest.get(filename)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    version = digest.hexdigest()[:12]
+    asset_manifest[filename] = (key, version)
+    return version
+
+def precompressAsset(path):
+    """Writes the .gz (and .br) variants of a static text file if outdated.
+    
+    Every worker runs this at startup, so each variant is written to a
+    temporary file and renamed into place; serveStatic() never sees a
+    partly written one.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    mtime = os.path.getmtime(path)
+    for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+        if encoding == 'br' and brotli is None:
+            continue
+        target = path + suffix
+        if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+            continue
+        if encoding == 'br':
+            compressed = brotli.compress(data, mode=brotli.MODE_TEXT)
+        else:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         suffix=suffix + '.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed)
+            os.replace(temp_path, target)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+def buildAssetManifest():
+    """Hashes and precompresses the site's own files in the static folder.
+    
+    The pictures in UPLOAD_FOLDER grow with every upload and are only hashed
+    when a page first links to them (see assetVersion), so a worker's startup
+    does not read all of them.
+    """
+    for folder, subfolders, files in os.walk(app.static_folder):
+        subfolders[:] = [name for name in subfolders
+                         if os.path.abspath(os.path.join(folder, name)) !=
+                         app.config['UPLOAD_FOLDER']]
+        for name in files:
+            if name.endswith(tuple(suffix for _, suffix in PRECOMPRESSED_ENCODINGS)):
+                continue
+            path = os.path.join(folder, name)
+            assetVersion(os.path.relpath(path, app.static_folder).replace(os.sep, '/'))
+            if name.endswith(PRECOMPRESSED_EXTENSIONS):
+                precompressAsset(path)
+
+buildAssetManifest()
+
+@app.url_defaults
+def fingerprintStatic(endpoint, values):
+    """Adds the content hash of the file to the URLs of static files."""
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = assetVersion(values['filename'])
+        if version:
+            values['v'] = version
+
+@app.endpoint('static')
+def serveStatic(filename):
+    """Serves a static file, replacing Flask's default static view.
+    
+    Fingerprinted URLs of the current file version are cached by browsers for
+    STATIC_IMMUTABLE_MAX_AGE seconds without revalidation. Text assets are
+    sent precompressed when the client accepts it.
+    """
+    immutable = request.args.get('v') is not None and \
+                request.args.get('v') == assetVersion(filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    path = filename
+    content_encoding = None
+    if filename.endswith(PRECOMPRESSED_EXTENSIONS):
+        source = safe_join(app.static_folder, filename)
+        for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+            if source is None or request.accept_encodings[encoding] <= 0:
+                continue
+            try:
+                if os.path.getmtime(source + suffix) >= os.path.getmtime(source):
+                    path, content_encoding = filename + suffix, encoding
+                    break
+            except OSError:
+                continue
+    
+    max_age = app.config['STATIC_IMMUTABLE_MAX_AGE'] if immutable else None
+    response = send_from_directory(app.static_folder, path, mimetype=mimetype,
+                                   max_age=max_age)
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    if filename.endswith(PRECOMPRESSED_EXTENSIONS):
+        response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
         
 # OAUTH SETUP FOR GOOGLE
 CLIENT_ID = json.loads(
@@ -90,7 +761,7 @@ APPLICATION_NAME = 'ICGDB'
 @app.route('/login')
 def showLogin():
     state = ''.join(random.choice(string.ascii_uppercase + string.digits)
-                    for x in xrange(32))
+                    for x in range(32))
     login_session['state'] = state
     return render_template('login.html', STATE = state)
 
@@ -235,6 +906,8 @@ def gdisconnect():
 # newGame() : create a new game page : 'GET', POST'
 # newGenre() : create a genre game page : 'GET', POST'
 # newPublisher() : create a new publisher page: 'GET', POST'
+#
+# viewSearch() : search games, genres and publishers
 
 @csrf.exempt
 @app.route('/')
@@ -258,30 +931,62 @@ def viewMain():
 
 @csrf.exempt                            
 @app.route('/main/games')
+@conditionalGet
+@cachedPage
 def viewGames():
     """Takes the user a page with a list of the games in the DB.
     
+    Only one page of GAMES_PAGE_SIZE games is rendered. The list is filtered
+    and sorted in SQL according to these optional query parameters:
+        genre: only show games of the genre with this name.
+        publisher: only show games of the publisher with this name.
+        min_rating: only show games rated at least this score (0-100).
+        max_price: only show games whose market value is at most this price.
+        sort: a key of GAMES_SORT_ORDERS, 'name' by default.
+        page: the 1-based page number.
+    
     If the user is logged in, render the html template with the drop-down buttons
     in the nav bar.
     """
-    games = session.query(Game).order_by(Game.name).all()
+    sort = request.args.get('sort', 'name')
+    if sort not in GAMES_SORT_ORDERS:
+        sort = 'name'
+    page = max(1, request.args.get('page', 1, type=int))
+    query = queryGames().filter(*gameFilters())
+    
+    page_size = app.config['GAMES_PAGE_SIZE']
+    games = query.order_by(*GAMES_SORT_ORDERS[sort][1]).limit(
+        page_size + 1).offset((page - 1) * page_size).all()
+    has_next = len(games) > page_size
+    games = games[:page_size]
     
     genre_names = listNames(Genre)
     pub_names = listNames(Publisher)
+    filters = {'genre': request.args.get('genre', ''),
+               'publisher': request.args.get('publisher', ''),
+               'min_rating': request.args.get('min_rating', ''),
+               'max_price': request.args.get('max_price', ''),
+               'sort': sort, 'page': page, 'has_next': has_next}
+    filters['args'] = dict((key, filters[key]) for key in
+                           ('genre', 'publisher', 'min_rating', 'max_price', 'sort')
+                           if filters[key])
     
     # renders public version of this page
     if 'username' not in login_session:
         return render_template('view_games.html', games=games,
                                 genre_names=genre_names,
-                                pub_names=pub_names)
+                                pub_names=pub_names, filters=filters,
+                                sort_orders=GAMES_SORT_ORDERS)
     
     # renders private version of this page
     return render_template('view_games.html', games=games,
                             genre_names=genre_names, pub_names=pub_names,
+                            filters=filters, sort_orders=GAMES_SORT_ORDERS,
                             username = login_session['username'])
 
 
 @app.route('/main/genres', methods=['GET', 'POST'])
+@conditionalGet
 def viewGenres():
     """Takes the user to a page with a list of the genres in the DB. GET and POST
     
@@ -307,6 +1012,7 @@ def viewGenres():
 
  
 @app.route('/main/publishers', methods=['GET', 'POST'])
+@conditionalGet
 def viewPublishers():
     """Takes the user to a page with a list of the publishers in the DB. GET and POST
     
@@ -331,6 +1037,7 @@ def viewPublishers():
                             STATE = login_session['state'])                            
                             
 @app.route('/main/games/<string:game_name>/', methods = ['GET', 'POST'])
+@conditionalGet
 def viewGamePage(game_name):
     """Takes the user to a game's page. GET and POST
     
@@ -340,14 +1047,9 @@ def viewGamePage(game_name):
     """
     game = session.query(Game).filter(Game.name==game_name).one()
 
-    if game.pic_url:
-        pic_url = url_for('static', filename='pics/'+game.pic_url)
-    else:
-        pic_url = url_for('static', filename='pics/'+'placeholder.png')
-    
     # renders public version of this page
     if 'username' not in login_session:
-        return render_template('view_game.html', game=game, pic_url=pic_url)
+        return render_template('view_game.html', game=game)
      
     
     if request.method == 'POST':  
@@ -355,17 +1057,20 @@ def viewGamePage(game_name):
             return redirect('/main/'+Game.__tablename__+'s/'+game_name)
             
         if request.form['button'] == 'Delete Game':
-            name = game.name
+            name, pic_url = game.name, game.pic_url
             session.delete(game)
             session.commit()
+            releasePicture(pic_url)
             flash('"%s" was deleted.' % name)
             return redirect(url_for('viewGames'))
         
-    return render_template('view_game.html', game=game, pic_url=pic_url,
+    return render_template('view_game.html', game=game,
                             username = login_session['username'],
                             STATE = login_session['state'])
     
 @app.route('/main/genres/<string:genre_name>/', methods = ['GET', 'POST'])
+@conditionalGet
+@cachedPage
 def viewGenrePage(genre_name):
     """Takes the user to a genre's page. GET and POST
     
@@ -374,20 +1079,17 @@ def viewGenrePage(genre_name):
         Edit and delete buttons 
     """
     genre = session.query(Genre).filter(Genre.name==genre_name).one()
-    games = session.query(Game).filter(Game.genre_name == genre_name).order_by(Game.name).all()
+    games, filters = relatedGames(genre)
+    stats = catalogStats(genre)
     
-    # pub_names is provided for the JS manipulations of the game list that 
-    # appears on a genre page
-    pub_names = []
-    for game in games:
-        if game.publisher_name not in pub_names:
-            pub_names.append(game.publisher_name)
-            pub_names.sort()
+    # pub_names fills the drop-down that filters the genre's games
+    pub_names = sorted(stats['publishers'])
     
     # if user is not logged in, render a page without a token and without certain buttons
     if 'username' not in login_session:
         return render_template('view_genre.html', genre=genre, games=games,
-                                pub_names=pub_names)
+                                pub_names=pub_names, stats=stats,
+                                filters=filters)
     
     if request.method == 'POST':
         if checkAuthor(genre_name, Genre): # checks if user is authorized to make changes
@@ -397,11 +1099,13 @@ def viewGenrePage(genre_name):
             return handleDelete(genre.name, Genre)
     
     return render_template('view_genre.html', genre=genre, games=games,
-                            pub_names=pub_names,
+                            pub_names=pub_names, stats=stats, filters=filters,
                             username = login_session['username'],
                             STATE = login_session['state'])
 
 @app.route('/main/publishers/<string:pub_name>/', methods = ['GET', 'POST'])
+@conditionalGet
+@cachedPage
 def viewPubPage(pub_name):
     """Takes the user to a publisher's page. GET and POST
     
@@ -410,21 +1114,18 @@ def viewPubPage(pub_name):
         Edit and delete buttons 
     """
     publisher = session.query(Publisher).filter(Publisher.name==pub_name).one()
-    games = session.query(Game).filter(Game.publisher_name == pub_name).order_by(Game.name).all()
+    games, filters = relatedGames(publisher)
+    stats = catalogStats(publisher)
     
-    # genre_names is provided for the JS manipulations of the game list that 
-    # appears on a publisher page
-    genre_names = []
-    for game in games:
-        if game.genre_name not in genre_names:
-            genre_names.append(game.genre_name)
-        genre_names.sort()
+    # genre_names fills the drop-down that filters the publisher's games
+    genre_names = sorted(stats['genres'])
     
     # if user is not logged in, render a page without a token and without
     # delete and edit buttons
     if 'username' not in login_session:
         return render_template('view_publisher.html', publisher=publisher,
-                                games=games,genre_names=genre_names)
+                                games=games, genre_names=genre_names,
+                                stats=stats, filters=filters)
         
     if request.method == 'POST':            
         if checkAuthor(pub_name, Publisher): # checks if user is authorized to make changes
@@ -434,7 +1135,8 @@ def viewPubPage(pub_name):
             return handleDelete(publisher.name, Publisher)
         
     return render_template('view_publisher.html', publisher=publisher,
-                            games=games, genre_names=genre_names,
+                            games=games, genre_names=genre_names, stats=stats,
+                            filters=filters,
                             username = login_session['username'],
                             STATE = login_session['state'])
   
@@ -476,26 +1178,29 @@ def editGame(game_name):
   
     if request.method == 'POST':      
         if request.form['button'] == 'Delete Game':
-            name = game.name
+            name, pic_url = game.name, game.pic_url
             session.delete(game)
             session.commit()
+            releasePicture(pic_url)
             flash('"%s" was deleted.' % name)
             return redirect(url_for('viewGames'))
     
-        if request.files['game-image']:
-            game.pic_url = uploadFile()
-        
         name=rqClean('name')
         if name: # editing a game to duplicate its name
-            if name in listNames(Game):
+            if nameExists(name, Game):
                 flash('Name already taken! "%s" NOT created!' % name)
                 return redirect('#')
             else:
                 game.name=name
+        
+        # the picture is stored only once the edit is known to go ahead
+        old_pic_url = game.pic_url
+        if request.files['game-image']:
+            game.pic_url = uploadFile() or old_pic_url
         if rqClean('genre') != game.genre_name:
-            game.genre_name = rqClean('genre')
+            game.genre = findByName(rqClean('genre'), Genre)
         if rqClean('publisher') != game.publisher_name:
-            game.publisher_name = rqClean('publisher')
+            game.publisher = findByName(rqClean('publisher'), Publisher)
         if rqClean('rdate'):
             rd = rqClean('rdate').split('-')
             rd = datetime(int(rd[0]),int(rd[1]),int(rd[2]))
@@ -515,6 +1220,8 @@ def editGame(game_name):
         if session.dirty:
             session.add(game)
             session.commit()
+            if game.pic_url != old_pic_url:
+                releasePicture(old_pic_url)
             flash('Game successfully edited.')
             return redirect(url_for('viewGamePage', game_name=game.name))
         else:
@@ -525,10 +1232,7 @@ def editGame(game_name):
     genre_names = listNames(Genre)
     pub_names = listNames(Publisher)
     
-    if game.pic_url:
-        pic_url = url_for('static', filename='pics/'+game.pic_url)
-    else:
-        pic_url = url_for('static', filename='pics/'+'placeholder.png')
+    pic_url = picUrl(game.pic_url)
     return render_template('edit_game.html', game=game, pic_url=pic_url,
                             pub_names=pub_names, genre_names=genre_names,
                             username = login_session['username'],
@@ -580,11 +1284,10 @@ def editGenre(genre_name):
         
         name = rqClean('name')
         if name:
-            if name in listNames(Genre):
+            if nameExists(name, Genre):
                 flash('Name already taken! "%s" NOT created!' % name)
                 return redirect('/main/newgenre')
             else:
-                old_name = genre.name
                 genre.name = name
         
         genre_descrip = rqClean('description')
@@ -594,31 +1297,20 @@ def editGenre(genre_name):
         if session.dirty:
             session.add(genre)
             session.commit()
-            flash('Genre successfully edited.')
-            
-            # update game table to reflect name change
             if name:
-                conn = engine.connect()
-                stmt = text("UPDATE game "
-                        "SET genre_name='%s' "
-                        "WHERE genre_name='%s'" % (name, old_name))
-                result = conn.execute(stmt)
-                result.close()
-            
+                invalidateNames(Genre)
+            flash('Genre successfully edited.')
             return redirect(url_for('viewGenrePage', genre_name=genre.name))
         else:
             flash('No changes saved.')
             return redirect(url_for('editGenre', genre_name=genre.name))
             
-    games = session.query(Game).filter(Game.genre_name == genre_name).order_by(Game.name).all()    
-    pub_names = []
-    for game in games:
-        if game.publisher_name not in pub_names:
-            pub_names.append(game.publisher_name)
-        pub_names.sort()
+    games, filters = relatedGames(genre)
+    stats = catalogStats(genre)
 
     return render_template('edit_genre.html', games=games, genre=genre,
-                            pub_names=pub_names,
+                            pub_names=sorted(stats['publishers']), stats=stats,
+                            filters=filters,
                             username = login_session['username'],
                             STATE = login_session['state'])
 
@@ -667,11 +1359,10 @@ def editPublisher(pub_name):
         
         name = rqClean('name')
         if name: # editing a publisher to duplicate its name
-            if name in listNames(Publisher):
+            if nameExists(name, Publisher):
                 flash('Name already taken! "%s" NOT created!' % name)
                 return redirect('#')
             else:
-                old_name = publisher.name
                 publisher.name=name
         
         publisher_descrip = rqClean('description')
@@ -682,31 +1373,20 @@ def editPublisher(pub_name):
         if session.dirty:
             session.add(publisher)
             session.commit()
-            flash('Publisher successfully edited.')
-            
-            # update game tables to reflect name change
             if name:
-                conn = engine.connect()
-                stmt = text("UPDATE game "
-                        "SET publisher_name='%s' "
-                        "WHERE publisher_name='%s'" % (name, old_name))
-                result = conn.execute(stmt)
-                result.close()
-            
+                invalidateNames(Publisher)
+            flash('Publisher successfully edited.')
             return redirect(url_for('viewPubPage', pub_name=publisher.name))
         else:
             flash('No changes saved.')
             return redirect(url_for('editPublisher', pub_name=publisher.name))
          
-    games = session.query(Game).filter(Game.publisher_name == pub_name).order_by(Game.name).all()
-    genre_names = []
-    for game in games:
-        if game.genre_name not in genre_names:
-            genre_names.append(game.genre_name)
-        genre_names.sort()
+    games, filters = relatedGames(publisher)
+    stats = catalogStats(publisher)
 
     return render_template('edit_publisher.html', games=games,
-                            publisher=publisher, genre_names=genre_names,
+                            publisher=publisher, genre_names=sorted(stats['genres']),
+                            stats=stats, filters=filters,
                             username = login_session['username'],
                             STATE = login_session['state'])
 
@@ -739,7 +1419,6 @@ def newGame():
         name, rating, genre_name, publisher_name = '', '', '', ''
         release_date, market_value, mv_date = None, '', None
         description = ''
-        game_names = listNames(Game)
         
         # check if user sent request with blank field for game name
         # if yes, then interrupt request and redirect user to newgame page.
@@ -747,7 +1426,7 @@ def newGame():
             if rqClean('name') == '':
                 flash('Game must have a name!')
                 return redirect('/main/newgame')
-            elif rqClean('name') in game_names:
+            elif nameExists(rqClean('name'), Game):
                 flash('Game name already taken! Game NOT created!')
                 return redirect('/main/newgame')
             else:
@@ -769,8 +1448,8 @@ def newGame():
         if rqClean('rating'):
             rating = rqClean('rating')
         
-        game = Game(name=name, genre_name=genre_name,
-        publisher_name=publisher_name, release_date=release_date,
+        game = Game(name=name, genre=findByName(genre_name, Genre),
+        publisher=findByName(publisher_name, Publisher), release_date=release_date,
         market_value=market_value, mv_date=mv_date, description=description,
         rating=rating, user_email=login_session['email'])
 
@@ -818,7 +1497,7 @@ def newGenre():
     if request.method == 'POST':
         name = rqClean('name')
         if name:
-            if name in listNames(Genre):
+            if nameExists(name, Genre):
                 flash('Name already taken! "%s" NOT created!' % name)
                 return redirect('/main/newgenre')
         else:
@@ -833,6 +1512,7 @@ def newGenre():
                       description=description)
         session.add(genre)
         session.commit()
+        invalidateNames(Genre)
         flash('"%s" was successfully created!' % name)
         
         return redirect(url_for('viewGenres'))
@@ -869,7 +1549,7 @@ def newPublisher():
     if request.method == 'POST':
         name = rqClean('name')
         if name:
-            if name in listNames(Publisher):
+            if nameExists(name, Publisher):
                 flash('Name already taken! "%s" NOT created!' % rqClean('name'))
                 return redirect('/main/newpublisher')
         else:
@@ -884,6 +1564,7 @@ def newPublisher():
                         description=description)
         session.add(pub)
         session.commit()
+        invalidateNames(Publisher)
         flash('"%s" was successfully created!' % name)
         
         return redirect(url_for('viewPublishers'))
@@ -894,145 +1575,588 @@ def newPublisher():
     
 
  
+@app.route('/main/search')
+@conditionalGet
+def viewSearch():
+    """Takes the user to a page of games, genres and publishers matching a search.
+    
+    The search terms are read from the 'q' parameter and the page number from
+    the 'page' parameter. Results are ranked with the best matches first.
+    """
+    terms = request.args.get('q', '')
+    page = max(1, request.args.get('page', 1, type=int))
+    results, has_next = searchCatalog(terms, page)
+    
+    # renders public version of this page
+    if 'username' not in login_session:
+        return render_template('search.html', terms=terms, results=results,
+                                page=page, has_next=has_next)
+    
+    # renders private version of this page
+    return render_template('search.html', terms=terms, results=results,
+                            page=page, has_next=has_next,
+                            username = login_session['username'])
+
+
 ### BEGIN JSON ENDPOINTS
 
 @app.route('/main/games/<string:game_name>/JSON')
+@conditionalGet
 def gameJSON(game_name):
     """Displays a game's information in JSON format."""
-    game = session.query(Game).filter_by(name=game_name).one()
+    game = queryGames().filter_by(name=game_name).one()
     return jsonify(game=game.serialize)
 
 @app.route('/main/games/JSON')
+@conditionalGet
 def gamesJSON():
-    """Displays the DB's games' information in JSON format."""
-    games=session.query(Game).all()
-    return jsonify(games=[r.serialize for r in games])
+    """Displays the DB's games' information in JSON format.
+
+    Without query parameters every game is returned in a single document.
+    Optional query parameters:
+        genre, publisher, min_rating, max_price: filter the games like the
+               games list does (see gameFilters()).
+        sort: a key of GAMES_JSON_SORT_KEYS, 'name' by default.
+        limit: return one page of at most 'limit' games. The response carries
+               a 'next' cursor while more games remain.
+        after: the 'next' cursor of the previous page.
+        stream: 'ndjson' streams one game object per line; 'json' streams the
+                same document as the unpaginated endpoint, chunk by chunk.
+    """
+    sort = request.args.get('sort', 'name')
+    if sort not in GAMES_JSON_SORT_KEYS:
+        return jsonError('Unknown sort order.', 400)
+    key = GAMES_JSON_SORT_KEYS[sort]
+    query = queryGames().filter(*gameFilters())
+    if key is None:
+        query = query.order_by(Game.name, Game.id)
+    else:
+        column, descending = key
+        query = query.filter(column.isnot(None)).order_by(
+            column.desc() if descending else column, Game.name, Game.id)
+
+    stream = request.args.get('stream')
+    if stream in ('ndjson', 'json'):
+        return streamGames(stream, query)
+
+    if 'limit' not in request.args and 'after' not in request.args:
+        games=query.all()
+        return jsonify(games=[r.serialize for r in games])
+
+    limit = request.args.get('limit', app.config['JSON_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['JSON_PAGE_MAX']))
+
+    # keyset pagination: continue after the (key, name, id) of the previous
+    # page's last game instead of using OFFSET, so every page costs the same
+    if request.args.get('after'):
+        cursor = decodeCursor(request.args.get('after'), sort)
+        if cursor is None:
+            return jsonError('Invalid cursor.', 400)
+        after = tuple_(Game.name, Game.id) > tuple_(*cursor[-2:])
+        if key is not None:
+            column, descending = key
+            beyond = column < cursor[0] if descending else column > cursor[0]
+            after = or_(beyond, and_(column == cursor[0], after))
+        query = query.filter(after)
+
+    games = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(games) > limit:
+        games = games[:limit]
+        next_cursor = encodeCursor(games[-1], sort)
+    return jsonify(games=[r.serialize for r in games], next=next_cursor)
+
+def streamGames(stream_format, query):
+    """Streams the games of an ordered query as NDJSON or as one chunked JSON
+    document.
+
+    Rows are fetched from the cursor in batches of JSON_STREAM_BATCH and
+    written out as they arrive, so memory use does not grow with the catalog.
+    """
+    games = query.yield_per(app.config['JSON_STREAM_BATCH'])
+
+    def generateNDJSON():
+        for game in games:
+            yield json.dumps(game.serialize) + '\n'
+
+    def generateJSON():
+        yield '{"games": ['
+        separator = ''
+        for game in games:
+            yield separator + json.dumps(game.serialize)
+            separator = ', '
+        yield ']}'
+
+    if stream_format == 'ndjson':
+        return Response(stream_with_context(generateNDJSON()),
+                        mimetype='application/x-ndjson')
+    return Response(stream_with_context(generateJSON()),
+                    mimetype='application/json')
     
 @app.route('/main/genres/JSON')
+@conditionalGet
 def genresJSON():
     """Displays the DB's genres' names and descriptions in JSON format."""
     genres=session.query(Genre).all()
     return jsonify(genres=[i.serialize for i in genres])
 
 @app.route('/main/publishers/JSON')
+@conditionalGet
 def publishersJSON():
     """Displays the DB's publishers' names and descriptions in JSON format."""
-    publishers=session.query(Genre).all()
+    publishers=session.query(Publisher).all()
     return jsonify(publishers=[i.serialize for i in publishers])    
     
 
+@app.route('/main/search/JSON')
+@conditionalGet
+def searchJSON():
+    """Displays a page of search results in JSON format (see viewSearch)."""
+    page = max(1, request.args.get('page', 1, type=int))
+    results, has_next = searchCatalog(request.args.get('q', ''), page)
+    return jsonify(results=results, page=page,
+                   next_page=page + 1 if has_next else None)
+
+@app.route('/main/<any(games, genres, publishers):kind>/bulk/JSON',
+           methods=['POST'])
+def bulkEditJSON(kind):
+    """Deletes or re-categorizes many games, genres or publishers at once.
+    
+    Requirement: A user must be logged in. Like forms, requests must carry
+    the CSRF token (in the X-CSRFToken header).
+    
+    The request body is a JSON object:
+        action: 'delete', or 'update' (games only) to change the genre and/or
+                publisher of the games.
+        names: the names of the games/genres/publishers.
+        genre, publisher: (update) the names of the new genre/publisher.
+    
+    Every named row is authorized in one query; if the user may not change
+    one of them, nothing is changed. All changes are made in one transaction
+    with one statement per BULK_CHUNK_SIZE names. As with the delete buttons,
+    the games of deleted genres/publishers are moved to "Other".
+    
+    Returns a JSON object with the number of 'changed' rows, the number of
+    'moved_games' and the names that were 'missing' from the database.
+    """
+    if 'username' not in login_session:
+        return jsonError('You must be logged in.', 401)
+    obj_class = BULK_KINDS[kind]
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    names = data.get('names')
+    if action not in ('delete', 'update') or \
+            (action == 'update' and obj_class is not Game):
+        return jsonError('Unsupported action.', 400)
+    if not isinstance(names, list) or \
+            not all(isinstance(name, str) for name in names):
+        return jsonError("'names' must be a list of strings.", 400)
+    if len(names) > app.config['BULK_MAX_ITEMS']:
+        return jsonError('At most %d names per request.'
+                         % app.config['BULK_MAX_ITEMS'], 400)
+    if obj_class is not Game and 'Other' in names:
+        return jsonError('You cannot delete "Other."', 400)
+    
+    values = {}
+    if action == 'update':
+        for key, ref_class in (('genre', Genre), ('publisher', Publisher)):
+            if data.get(key) is not None:
+                ref = findByName(data[key], ref_class)
+                if ref is None:
+                    return jsonError('Unknown %s "%s".' % (key, data[key]), 400)
+                values[getattr(Game, key + '_id')] = ref.id
+        if not values:
+            return jsonError("Give a 'genre' and/or 'publisher'.", 400)
+    
+    # one pass: look up every row and check the user may change all of them
+    names = sorted(set(names))
+    rows = []
+    for chunk in chunks(names, BULK_CHUNK_SIZE):
+        rows.extend(session.query(obj_class.id, obj_class.name,
+                                  obj_class.user_email).filter(
+            obj_class.name.in_(chunk)).all())
+    if not isSuperUser(login_session['email']):
+        forbidden = sorted(row.name for row in rows
+                           if row.user_email != login_session['email'])
+        if forbidden:
+            response = jsonify(error='You are not the creator of these %s.' % kind,
+                               forbidden=forbidden)
+            response.status_code = 403
+            return response
+    found = set(row.name for row in rows)
+    ids = [row.id for row in rows]
+    
+    moved = 0
+    pic_urls = set()
+    if obj_class is Game:
+        if action == 'delete':
+            for chunk in chunks(ids, BULK_CHUNK_SIZE):
+                pic_urls.update(pic for (pic,) in session.query(Game.pic_url)
+                                .filter(Game.id.in_(chunk), Game.pic_url.isnot(None)))
+                removed = gameStatsGroups(session, Game.id.in_(chunk))
+                session.query(Game).filter(Game.id.in_(chunk)).delete(
+                    synchronize_session=False)
+                updateCatalogStats(session, removed=removed)
+        else:
+            for chunk in chunks(ids, BULK_CHUNK_SIZE):
+                moveGames(Game.id.in_(chunk), values)
+    else:
+        other = findByName('Other', obj_class)
+        fk_column = getattr(Game, obj_class.__tablename__ + '_id')
+        for chunk in chunks(ids, BULK_CHUNK_SIZE):
+            moved += moveGames(fk_column.in_(chunk),
+                               {fk_column: other.id if other else None})
+            dropCatalogStats(session, obj_class.__tablename__, chunk)
+            session.query(obj_class).filter(obj_class.id.in_(chunk)).delete(
+                synchronize_session=False)
+    session.commit()
+    
+    if obj_class is not Game:
+        invalidateNames(obj_class)
+    for pic_url in pic_urls:
+        releasePicture(pic_url)
+    return jsonify(changed=len(ids), moved_games=moved,
+                   missing=[name for name in names if name not in found])
+
+@app.route('/main/<any(genres, publishers):kind>/stats/JSON')
+@conditionalGet
+def statsJSON(kind):
+    """Displays the game statistics of the genres or publishers in JSON format.
+    
+    Optional query parameter:
+        name: only return the statistics of the genre/publisher with this name.
+    
+    See catalogStats(); dates are formatted as YYYY-MM-DD.
+    """
+    obj_class = BULK_KINDS[kind]
+    stats_class = STATS_KINDS[obj_class][0]
+    stats_id = getattr(stats_class, obj_class.__tablename__ + '_id')
+    query = session.query(obj_class, stats_class).outerjoin(
+        stats_class, stats_id == obj_class.id).order_by(obj_class.name)
+    if request.args.get('name'):
+        query = query.filter(obj_class.name == request.args.get('name'))
+    rows = query.all()
+    related = dict((obj.id, {}) for obj, _ in rows)
+    pairs = queryPairedNames(obj_class, list(related) if request.args.get('name')
+                             else None)
+    for obj_id, name, count in pairs:
+        if obj_id in related:
+            related[obj_id][name] = count
+    entries = []
+    for obj, stats in rows:
+        entry = catalogStats(obj, stats, related[obj.id])
+        if entry['latest_release'] is not None:
+            entry['latest_release'] = entry['latest_release'].isoformat()
+        entry['name'] = obj.name
+        entries.append(entry)
+    return jsonify({kind: entries})
+
+@app.route('/main/cache/JSON')
+def cacheStatsJSON():
+    """Displays the hit/miss counters of the in-process caches in JSON format."""
+    with name_cache_lock:
+        names = dict(name_cache_stats)
+    with superuser_cache_lock:
+        superusers = dict(superuser_cache_stats)
+    with page_cache_lock:
+        pages = dict(page_cache_stats, size=len(page_cache))
+    return jsonify(names=names, superusers=superusers, pages=pages)
+
+
 ### BEGIN XML Endpoints
 
-def gameXMLHelper(games):
-    """This is a helper function for gameXML and gamesXML.
+# XML responses are written out by xmlStream() one element at a time as rows
+# come off the DB cursor, so exports never hold the whole document in memory.
+
+def xmlStream(root_tag, rows, to_element):
+    """Yields an XML document containing one element per row.
     
     Arguments:
-        games: a list containing Game objects.
+        root_tag: the tag name of the document's root element.
+        rows: an iterable of objects, eg a query.
+        to_element: a function returning a row's XML element as a string.
     
     Returns:
-        Returns an XML-formatted string carrying game(s) information.
+        A generator of UTF-8 XML text chunks.
     """
-    games_list = [r.serialize for r in games]
-    games_string=''
-    for game_obj in games_list:
-        # create xml elements and subelements
-        game = ET.Element('game', attrib={'genre': game_obj['genre'],
-                                          'publisher': game_obj['publisher']})
-        name = ET.SubElement(game, 'name')
-        description = ET.SubElement(game, 'description')
-        release_date = ET.SubElement(game, 'release_date')
-        rating = ET.SubElement(game, 'rating')
-        market_value = ET.SubElement(game, 'market_value')
-        mv_date = ET.SubElement(game, 'mv_date')
-    
-        # insert text into elements and subelements
-        name.text = game_obj['name']
-        description.text = game_obj['description']
-        release_date.text = game_obj['release_date']
-        rating.text = game_obj['rating']
-        market_value.text = game_obj['market_value']
-        mv_date.text = game_obj['mv_date']
-        games_string+= ET.tostring(game, encoding='us-ascii', method='xml')
-        
-    return games_string
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<%s>' % root_tag
+    for row in rows:
+        yield to_element(row)
+    yield '</%s>\n' % root_tag
+
+def xmlResponse(root_tag, rows, to_element):
+    """Returns a chunked Response streaming the output of xmlStream()."""
+    return Response(stream_with_context(xmlStream(root_tag, rows, to_element)),
+                    mimetype='application/xml')
+
+def xmlElement(tag, attrib, children):
+    """Returns an XML element with text-only children as an escaped string.
+    
+    Arguments:
+        tag: the element's tag name.
+        attrib: a list of (name, value) pairs for the element's attributes.
+        children: a list of (tag, text) pairs for the element's subelements.
+    """
+    parts = ['<', tag]
+    for name, value in attrib:
+        parts.append(' %s=%s' % (name, quoteattr(xmlText(value))))
+    parts.append('>')
+    for child_tag, value in children:
+        parts.append('<%s>%s</%s>' % (child_tag, escape(xmlText(value)), child_tag))
+    parts.append('</%s>' % tag)
+    return ''.join(parts)
+
+def xmlText(value):
+    """Converts a column value to text that is allowed in an XML document."""
+    if value is None:
+        return ''
+    return XML_INVALID_CHARS.sub('', str(value))
+
+def gameXMLElement(game):
+    """Returns a Game object as a <game> XML element string."""
+    game_obj = game.serialize
+    return xmlElement('game',
+                      [('genre', game_obj['genre']),
+                       ('publisher', game_obj['publisher'])],
+                      [('name', game_obj['name']),
+                       ('description', game_obj['description']),
+                       ('release_date', game_obj['release_date']),
+                       ('rating', game_obj['rating']),
+                       ('market_value', game_obj['market_value']),
+                       ('mv_date', game_obj['mv_date'])])
+
+def descriptionXMLElement(tag):
+    """Returns a function converting a Genre/Publisher to an XML string."""
+    def toElement(obj):
+        return xmlElement(tag, [], [('name', obj.name),
+                                    ('description', obj.description)])
+    return toElement
 
 @app.route('/main/games/<string:game_name>/XML')
+@conditionalGet
 def gameXML(game_name):
     """Displays a game's information in XML format."""
-    game = [session.query(Game).filter_by(name=game_name).one()]
-    return gameXMLHelper(game)
+    game = [queryGames().filter_by(name=game_name).one()]
+    # a single game is small enough to be written out before the request ends
+    return Response(''.join(xmlStream('games', game, gameXMLElement)),
+                    mimetype='application/xml')
 
 @app.route('/main/games/XML')
+@conditionalGet
 def gamesXML():
     """Displays the DB's games' information in XML format."""
-    games=session.query(Game).all()
-    return gameXMLHelper(games)
+    games = queryGames().order_by(Game.name, Game.id).yield_per(
+        app.config['JSON_STREAM_BATCH'])
+    return xmlResponse('games', games, gameXMLElement)
     
 @app.route('/main/genres/XML')
+@conditionalGet
 def genresXML():
     """Displays the DB's genres' names and descriptions in XML format."""
-    genres=session.query(Genre).all()
-    genres=[i.serialize for i in genres]
-    
-    genres_string=''
-    for genre_obj in genres:
-        # create xml elements and subelements
-        genre = ET.Element('genre')
-        name = ET.SubElement(genre, 'name')
-        description = ET.SubElement(genre, 'description')
-        
-        # insert text into elements and subelements
-        name.text = genre_obj['name']
-        description.text = genre_obj['description']
-
-        genres_string+= ET.tostring(genre, encoding='us-ascii', method='xml')
-        
-    return genres_string
+    genres = session.query(Genre).order_by(Genre.name)
+    return xmlResponse('genres', genres, descriptionXMLElement('genre'))
 
 @app.route('/main/publishers/XML')
+@conditionalGet
 def publishersXML():
     """Displays the DB's publishers' names and descriptions in XML format."""
-    publishers=session.query(Publisher).all()
-    publishers=[i.serialize for i in publishers]
-    
-    pub_string=''
-    for pub_obj in publishers:
-        # create xml elements and subelements
-        pub = ET.Element('publisher')
-        name = ET.SubElement(pub, 'name')
-        description = ET.SubElement(pub, 'description')
-        
-        # insert text into elements and subelements
-        name.text = pub_obj['name']
-        description.text = pub_obj['description']
-
-        pub_string+= ET.tostring(pub, encoding='us-ascii', method='xml')
-        
-    return pub_string
+    publishers = session.query(Publisher).order_by(Publisher.name)
+    return xmlResponse('publishers', publishers, descriptionXMLElement('publisher'))
 #END XML Endpoints
     
 ###  Helper Functions
 
+def queryGames():
+    """Returns a query for Game objects with their genre and publisher loaded.
+
+    The genre and publisher rows are fetched in the same SELECT as the games
+    (LEFT OUTER JOIN), so serializing or rendering a list of games does not
+    issue two extra queries per game.
+    """
+    return session.query(Game).options(joinedload(Game.genre),
+                                       joinedload(Game.publisher))
+
+def relatedGames(obj):
+    """Returns one page of the games of a genre/publisher.
+    
+    The games are listed in name order from the genre's/publisher's
+    (<kind>_id, name) index, GAMES_PAGE_SIZE per page. These optional query
+    parameters apply:
+        publisher (genre pages) or genre (publisher pages): only show the
+            games of the publisher/genre with this name (see gameFilters).
+        page: the 1-based page number.
+    
+    Args:
+        obj: a Genre or Publisher object.
+    
+    Returns:
+        A (games, filters) pair. filters holds the filter's value, 'page',
+        'has_next' and 'args', the non-empty parameters for page links.
+    """
+    param = STATS_KINDS[type(obj)][1].__tablename__
+    fk_column = getattr(Game, type(obj).__tablename__ + '_id')
+    query = queryGames().filter(fk_column == obj.id, *gameFilters())
+    related_name = request.args.get(param, '')
+    
+    page = max(1, request.args.get('page', 1, type=int))
+    page_size = app.config['GAMES_PAGE_SIZE']
+    games = query.order_by(Game.name).limit(page_size + 1).offset(
+        (page - 1) * page_size).all()
+    filters = {param: related_name, 'page': page,
+               'has_next': len(games) > page_size,
+               'args': {param: related_name} if related_name else {}}
+    return games[:page_size], filters
+
+def catalogStats(obj, stats=None, related=None):
+    """Returns the game statistics of a genre or publisher.
+    
+    The counters are read from the genre's/publisher's stats row, a primary
+    key lookup, and the publishers of a genre (or the genres of a publisher)
+    from the 'genre_publisher_stats' table, so the cost does not grow with
+    the number of games.
+    
+    Args:
+        obj: a Genre or Publisher object.
+        stats, related: if already loaded, its GenreStats/PublisherStats
+                        object (None if it has none) and the {name: game
+                        count} of its paired publishers/genres.
+    
+    Returns:
+        A dict with the 'game_count', 'rated_count', 'average_rating' and
+        'latest_release' of the games, and {name: game count} of their
+        'publishers' (for a genre) or 'genres' (for a publisher).
+    """
+    stats_class, other_class, key = STATS_KINDS[type(obj)]
+    if related is None:
+        stats = session.get(stats_class, obj.id)
+        related = dict((name, count) for _, name, count in
+                       queryPairedNames(type(obj), [obj.id]))
+    return {'game_count': stats.game_count if stats else 0,
+            'rated_count': stats.rated_count if stats else 0,
+            'average_rating': stats.average_rating if stats else None,
+            'latest_release': stats.latest_release if stats else None,
+            key: related}
+
+def queryPairedNames(obj_class, ids=None):
+    """Returns a query for the publishers of genres, or genres of publishers.
+    
+    Args:
+        obj_class: Genre or Publisher.
+        ids: the ids of the genres/publishers, or None for all of them.
+    
+    Returns:
+        A query of (genre/publisher id, paired name, game count) rows.
+    """
+    other_class = STATS_KINDS[obj_class][1]
+    own_column = getattr(GenrePublisherStats, obj_class.__tablename__ + '_id')
+    other_column = getattr(GenrePublisherStats, other_class.__tablename__ + '_id')
+    query = session.query(own_column, other_class.name,
+                          GenrePublisherStats.game_count).join(
+        other_class, other_column == other_class.id)
+    if ids is not None:
+        query = query.filter(own_column.in_(ids))
+    return query
+
+def gameFilters():
+    """Returns the SQL conditions selected by the games list's query parameters.
+
+    The parameters are 'genre' and 'publisher' (names; an unknown name matches
+    no games), 'min_rating' (a 0-100 score) and 'max_price' (e.g. '20' or
+    '$19.99'). Games without a rating/price never match a rating/price bound.
+    """
+    conditions = []
+    for key, model, column in (('genre', Genre, Game.genre_id),
+                               ('publisher', Publisher, Game.publisher_id)):
+        if request.args.get(key):
+            obj = findByName(request.args.get(key), model)
+            conditions.append(column == obj.id if obj else false())
+    min_rating = request.args.get('min_rating', type=int)
+    if min_rating is not None:
+        conditions.append(Game.rating_score >= min_rating)
+    max_price = parsePrice(request.args.get('max_price'))
+    if max_price is not None:
+        conditions.append(Game.market_price <= max_price)
+    return conditions
+
 def listNames(obj):
     """Fetches names from a specified Class/'table'
     
+    Genre and Publisher names are served from the in-process name cache and
+    are only queried again once the catalog version changed.
+    
     Args:
         obj: a class name from icgb_database_setup.py, eg Game, User, etc
         
     Return:
-        A list of names (strings).
+        A sorted list of names (strings). Callers must not modify the list.
+    """
+    return cachedNames(obj)[0]
+
+def nameExists(name, obj):
+    """Checks if a Genre/Publisher/Game with the given name exists.
+    
+    Genre and Publisher names are looked up in the cached set of names; game
+    names are checked with a query against the indexed game.name column.
     """
-    names = session.query(obj.name).order_by(obj.name).all()
-    for i in range(0, len(names)):
-        names[i] = str(names[i][0])
+    if obj in CACHED_NAME_CLASSES:
+        return name in cachedNames(obj)[1]
+    return session.query(obj.id).filter(obj.name==name).first() is not None
+
+def cachedNames(obj):
+    """Returns a (sorted list, set) pair of the names in a Class/'table'."""
+    if obj in CACHED_NAME_CLASSES:
+        version = currentCatalogVersion()[0]
+        with name_cache_lock:
+            cached = name_cache.get(obj)
+            if cached is not None and cached[0] == version:
+                name_cache_stats['hits'] += 1
+                return cached[1]
+    
+    names = [str(row[0]) for row in
+             session.query(obj.name).order_by(obj.name).all()]
+    names = (names, frozenset(names))
+    if obj in CACHED_NAME_CLASSES:
+        with name_cache_lock:
+            name_cache_stats['misses'] += 1
+            name_cache[obj] = (version, names)
     return names
 
+def invalidateNames(obj):
+    """Drops the cached names of a Class/'table' after they were changed.
+    
+    Must be called after the change was committed, otherwise another request
+    could refill the cache with the old names.
+    """
+    with name_cache_lock:
+        name_cache.pop(obj, None)
+
 def listSuperUsers():
-    """ Return a list of 'superusers' from the DB """
-    superusers = session.query(User.email).filter_by(privilege='superuser').all()
-    for i in range(0,len(superusers)):
-        superusers[i] = str(superusers[i][0])
-    return superusers
+    """ Return a set of 'superusers' emails
+    
+    The set is cached in-process for SUPERUSER_CACHE_TTL seconds and reloaded
+    from the DB once it expires or after invalidateSuperUsers() was called.
+    """
+    with superuser_cache_lock:
+        if time.time() < superuser_cache['expires']:
+            superuser_cache_stats['hits'] += 1
+            return superuser_cache['emails']
+    
+    superusers = frozenset(str(row[0]) for row in
+                           session.query(User.email).filter_by(privilege='superuser'))
+    with superuser_cache_lock:
+        superuser_cache_stats['misses'] += 1
+        superuser_cache['emails'] = superusers
+        superuser_cache['expires'] = time.time() + app.config['SUPERUSER_CACHE_TTL']
+        return superusers
+
+def invalidateSuperUsers():
+    """Forces the next listSuperUsers() call to reload the set from the DB."""
+    with superuser_cache_lock:
+        superuser_cache['expires'] = 0.0
+
+def isSuperUser(email):
+    """Checks if the user with the given email is a 'superuser'."""
+    return email in listSuperUsers()
 
 def checkAuthor(obj_name, obj_class):
     """Determines if a user has the authority to make a change.
@@ -1046,15 +2170,16 @@ def checkAuthor(obj_name, obj_class):
         Returns False if a user IS authorized to make a change.
     """
     toDeleteName = obj_name
-    superUsers = listSuperUsers()
     
-    creator_email = session.query(obj_class).filter(obj_class.name==toDeleteName).first().user_email
-    print(creator_email)
-    checkSuper = (login_session['email'] in superUsers) # if True, user IS authorized
+    # superusers may change anything, so the creator lookup is only needed
+    # for regular users
+    if isSuperUser(login_session['email']):
+        return False # user is authorized to make change
     
+    creator_email = session.query(obj_class.user_email).filter(obj_class.name==toDeleteName).first()[0]
     
     # checks authority of user to make a change
-    if login_session['email'] == creator_email or checkSuper: 
+    if login_session['email'] == creator_email: 
         return False # user is authorized to make change
     flash('You are not the creator of this %s, you may not edit/delete it.' % obj_class.__tablename__)
     return True # user is NOT authorized to make change
@@ -1072,7 +2197,6 @@ def handleDelete(obj_name, obj_class):
         to genre or publisher page.
     """
     toDeleteName = obj_name
-    superUsers = listSuperUsers()
     
     # prevents 'Other' from being deleted.
     # 'Other' is important because when a genre/publisher is deleted, the
@@ -1082,23 +2206,203 @@ def handleDelete(obj_name, obj_class):
         flash('You cannot delete "Other."')
         return redirect('/main/'+obj_class.__tablename__+'s/'+toDeleteName)    
     
-    # The following code block updates the genre_name/publisher_name values of
-    # the game object if these values no longer exist in the Genre/Publisher
-    # tables. Values are updated to "other"
-    t_name = obj_class.__tablename__
-    conn = engine.connect()
-    stmt = text("UPDATE game "
-                "SET %s_name='%s' "
-                "WHERE %s_name='%s'" % (t_name,'Other', t_name, toDeleteName))
-    result = conn.execute(stmt)
-    result.close()
-            
     toDelete = session.query(obj_class).filter(obj_class.name==toDeleteName).all()[0]
+    other = findByName('Other', obj_class)
+    
+    # The following code block updates the genre_id/publisher_id values of
+    # the games that belong to the deleted genre/publisher so that they point
+    # to "Other" instead. The games added while the batches were moved are
+    # swept up by one last UPDATE, committed together with the deletion.
+    fk_column = getattr(Game, obj_class.__tablename__ + '_id')
+    new_id = other.id if other else None
+    moved = repointGames(fk_column, toDelete.id, new_id)
+    moved += moveGames(fk_column == toDelete.id, {fk_column: new_id})
     session.delete(toDelete)
     session.commit()
-    flash('"%s" has been deleted.' % toDeleteName)
+    invalidateNames(obj_class)
+    flash('"%s" has been deleted. %d game(s) were moved to "Other".'
+          % (toDeleteName, moved))
     return redirect('/main/'+obj_class.__tablename__+'s')
   
+def repointGames(fk_column, old_id, new_id):
+    """Moves the games of a genre/publisher to another one in batches.
+    
+    Each batch of CASCADE_BATCH_SIZE games is updated and committed in its
+    own transaction, so a large genre never blocks other writers for long.
+    Every batch leaves the catalog consistent, so if a request fails half-way
+    the games moved so far stay valid and repeating it finishes the job.
+    Games added meanwhile may still point at old_id; the caller moves those
+    in the transaction that deletes the genre/publisher.
+    
+    Args:
+        fk_column: Game.genre_id or Game.publisher_id.
+        old_id: the id of the genre/publisher the games are moved away from.
+        new_id: the id of the genre/publisher they are moved to, or None.
+    
+    Returns:
+        The number of games moved.
+    """
+    batch_size = app.config['CASCADE_BATCH_SIZE']
+    moved = 0
+    while True:
+        batch = session.execute(select(Game.id).where(fk_column == old_id)
+                                .limit(batch_size)).scalars().all()
+        moveGames(Game.id.in_(batch), {fk_column: new_id})
+        session.commit()
+        moved += len(batch)
+        if len(batch) < batch_size:
+            return moved
+
+def moveGames(whereclause, values):
+    """Changes the genre and/or publisher of games with one UPDATE statement.
+    
+    The genre and publisher stats are adjusted in the same transaction.
+    
+    Args:
+        whereclause: a condition selecting the games.
+        values: {Game.genre_id and/or Game.publisher_id: the new id or None}.
+    
+    Returns:
+        The number of games changed.
+    """
+    removed = gameStatsGroups(session, whereclause)
+    count = session.query(Game).filter(whereclause).update(
+        values, synchronize_session=False)
+    added = []
+    for group in removed:
+        group = list(group)
+        for column, value in values.items():
+            group[0 if column.key == 'genre_id' else 1] = value
+        added.append(tuple(group))
+    updateCatalogStats(session, removed, added)
+    return count
+
+def searchCatalog(terms, page):
+    """Runs a full-text search over games, genres and publishers.
+    
+    SQLite databases are searched through the FTS5 'search_index' table,
+    other databases with searchCatalogLike().
+    
+    Args:
+        terms: the user's search string. Every word must match, and the last
+               characters of a word may be missing (prefix search).
+        page: the 1-based number of the page of results to return.
+    
+    Returns:
+        A (results, has_next) pair. results is a list of dicts with the
+        'kind' ('game', 'genre' or 'publisher'), 'name' and an 'excerpt' of
+        the description, best matches first. has_next is True if another
+        page of results exists.
+    """
+    words = re.findall(r'\w+', terms, re.UNICODE)
+    if not words:
+        return [], False
+    if engine.dialect.name != 'sqlite':
+        return searchCatalogLike(words, page)
+    
+    # quote each word so that user input cannot use FTS5 query syntax, and
+    # weight matches in names ten times higher than matches in descriptions
+    match = ' '.join('"%s"*' % word for word in words)
+    page_size = app.config['SEARCH_PAGE_SIZE']
+    rows = session.execute(text(
+        "SELECT kind, name, "
+        "snippet(search_index, 3, '', '', '...', 16) AS excerpt "
+        "FROM search_index WHERE search_index MATCH :match "
+        "ORDER BY bm25(search_index, 0.0, 0.0, 10.0, 1.0) "
+        "LIMIT :limit OFFSET :offset"),
+        {'match': match, 'limit': page_size + 1,
+         'offset': (page - 1) * page_size}).fetchall()
+    
+    results = [{'kind': row.kind, 'name': row.name, 'excerpt': row.excerpt}
+               for row in rows[:page_size]]
+    return results, len(rows) > page_size
+
+def searchCatalogLike(words, page):
+    """Searches games, genres and publishers with case-insensitive LIKE.
+    
+    Used on databases without SQLite's FTS5. Every word must appear in the
+    name or description; rows matching every word in their name come first.
+    Takes the words of the search string and returns the same as
+    searchCatalog().
+    """
+    selects = []
+    for kind, obj_class in (('game', Game), ('genre', Genre),
+                            ('publisher', Publisher)):
+        in_name = and_(*[obj_class.name.icontains(word, autoescape=True)
+                         for word in words])
+        selects.append(session.query(
+            literal(kind).label('kind'), obj_class.name.label('name'),
+            obj_class.description.label('description'),
+            case((in_name, 0), else_=1).label('rank')).filter(and_(*[
+                or_(obj_class.name.icontains(word, autoescape=True),
+                    obj_class.description.icontains(word, autoescape=True))
+                for word in words])).statement)
+    matches = union_all(*selects).subquery()
+    
+    page_size = app.config['SEARCH_PAGE_SIZE']
+    rows = session.execute(
+        matches.select().order_by(matches.c.rank, matches.c.name)
+        .limit(page_size + 1).offset((page - 1) * page_size)).fetchall()
+    
+    results = [{'kind': row.kind, 'name': row.name,
+                'excerpt': excerpt(row.description or '', words)}
+               for row in rows[:page_size]]
+    return results, len(rows) > page_size
+
+def excerpt(description, words, width=100):
+    """Returns about 'width' characters of a description around a search word."""
+    lowered = description.lower()
+    positions = [lowered.find(word.lower()) for word in words]
+    start = max(0, min([p for p in positions if p >= 0] or [0]) - width // 4)
+    fragment = description[start:start + width]
+    return ('...' if start else '') + fragment + \
+           ('...' if start + width < len(description) else '')
+
+def findByName(obj_name, obj_class):
+    """Returns the Genre/Publisher/Game named obj_name, or None if none exists."""
+    return session.query(obj_class).filter(obj_class.name==obj_name).first()
+
+def encodeCursor(game, sort='name'):
+    """Returns an opaque pagination cursor pointing just after 'game'.
+
+    The cursor holds the game's sort key (see GAMES_JSON_SORT_KEYS), if any,
+    followed by its name and id.
+    """
+    values = [game.name, game.id]
+    if sort == 'rating':
+        values.insert(0, game.rating_score)
+    elif sort == 'price':
+        values.insert(0, str(game.market_price))
+    raw = json.dumps(values).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decodeCursor(cursor, sort='name'):
+    """Returns the values stored in a cursor of a sort order, or None if invalid."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(values, list) or \
+                len(values) != (2 if sort == 'name' else 3) or \
+                not isinstance(values[-1], int):
+            return None
+        if sort == 'rating' and not isinstance(values[0], int):
+            return None
+        if sort == 'price':
+            values[0] = Decimal(values[0])
+    except (ValueError, TypeError, ArithmeticError):
+        return None
+    return values
+
+def chunks(items, size):
+    """Yields successive slices of at most 'size' items of a list."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def jsonError(message, status):
+    """Returns a JSON {'error': message} response with the given status."""
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
+
 def rqClean(name):
     """Request and sanitize input from html forms."""
     return bleach.clean(request.form[name])
@@ -1116,8 +2420,24 @@ def createUser(email):
     newUser = User(name=login_session['username'], email=email)
     session.add(newUser)
     session.commit()
+    invalidateSuperUsers()
     #user = session.query(User).filter_by(email=login_session['email']).one()
     
+def setPrivilege(email, privilege):
+    """Changes the privilege of a user, eg to 'superuser' or to None.
+    
+    Argument:
+        email: a string containing the email address of the user.
+        privilege: the new privilege string, or None for a regular user.
+        
+    Return:
+        Does not return anything. Commits transaction to the database.
+    """
+    user = session.query(User).filter_by(email=email).one()
+    user.privilege = privilege
+    session.commit()
+    invalidateSuperUsers()
+    
 def checkEmail(email):
     """Checks if the user email exists in the database."""
     try:
@@ -0,0 +1,200 @@
+"""This module load-tests the async OAuth endpoints of asgi_server.py.
+
+License: GPLv3
+Module Description: This module starts a local stub of Google's token,
+tokeninfo, userinfo and revoke endpoints that answers every request after a
+configurable delay, points asgi_server.py at it and logs many simulated users
+in (/gconnect) and out (/gdisconnect) at the same time. Requests are sent to
+the ASGI app in-process, so the numbers measure the app and not a network.
+With async outbound calls, the total time stays close to one user's round
+trips however many users log in at once.
+
+Usage:
+    $ python loadtest_oauth.py
+    $ python loadtest_oauth.py --users 1000 --concurrency 200 --latency 0.5
+
+The users are written to a scratch SQLite database unless --database is
+given. Like the app, this must be run from the directory holding
+client_secrets.json.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import secrets
+import socket
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs
+
+USERS = 200 # simulated users
+CONCURRENCY = 50 # users logging in at the same time
+LATENCY = 0.2 # seconds the stub waits before answering
+
+
+###  Google Stub
+
+def fakeIdToken(sub):
+    """Returns an unsigned ID token carrying a user id."""
+    def encode(data):
+        raw = json.dumps(data).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+    return '%s.%s.' % (encode({'alg': 'none'}), encode({'sub': sub}))
+
+def stubApp(client_id, latency):
+    """Returns a Starlette app answering like Google's OAuth endpoints.
+
+    The access token handed out for the code 'code-<n>' is 'token-<n>', and
+    belongs to the user with id '<n>'.
+    """
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+
+    async def token(request):
+        await asyncio.sleep(latency)
+        form = parse_qs((await request.body()).decode('utf-8'))
+        code = form.get('code', [''])[0]
+        if not code.startswith('code-'):
+            return JSONResponse({'error': 'invalid_grant'}, status_code=400)
+        user = code[len('code-'):]
+        return JSONResponse({'access_token': 'token-' + user,
+                             'id_token': fakeIdToken(user),
+                             'token_type': 'Bearer', 'expires_in': 3600})
+
+    async def tokeninfo(request):
+        await asyncio.sleep(latency)
+        user = request.query_params['access_token'][len('token-'):]
+        return JSONResponse({'user_id': user, 'issued_to': client_id})
+
+    async def userinfo(request):
+        await asyncio.sleep(latency)
+        user = request.query_params['access_token'][len('token-'):]
+        return JSONResponse({'name': 'Load Test %s' % user,
+                             'email': 'loadtest-%s@example.invalid' % user,
+                             'picture': 'https://example.invalid/%s.png' % user})
+
+    async def revoke(request):
+        await asyncio.sleep(latency)
+        return JSONResponse({})
+
+    return Starlette(routes=[
+        Route('/token', token, methods=['POST']),
+        Route('/tokeninfo', tokeninfo),
+        Route('/userinfo', userinfo),
+        Route('/revoke', revoke),
+    ])
+
+def freePort():
+    """Returns a free TCP port on the loopback interface."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+###  Load Test
+
+async def simulateUser(client, asgi_server, user, timings, failures):
+    """Logs one user in and out, recording the time each request took."""
+    state = 'state-%d' % user
+    cookie = asgi_server.flask_app.session_interface.get_signing_serializer(
+        asgi_server.flask_app).dumps({'state': state})
+    name = asgi_server.flask_app.config['SESSION_COOKIE_NAME']
+    for method, url, body in (('POST', '/gconnect?state=' + state, 'code-%d' % user),
+                              ('GET', '/gdisconnect', None)):
+        start = time.perf_counter()
+        response = await client.request(method, url, content=body,
+                                        headers={'Cookie': name + '=' + cookie})
+        timings.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            failures.append((url, response.status_code, response.text[:80]))
+            return
+        cookie = response.cookies.get(name, cookie)
+
+async def runLoadTest(args):
+    import httpx
+    import uvicorn
+    import asgi_server
+    from icgdb_database_setup import makeEngine, upgradeDatabase
+
+    upgradeDatabase(makeEngine())
+    port = freePort()
+    stub = uvicorn.Server(uvicorn.Config(
+        stubApp(asgi_server.CLIENT_ID, args.latency), host='127.0.0.1',
+        port=port, log_level='warning', lifespan='off'))
+    stub_task = asyncio.create_task(stub.serve())
+    while not stub.started:
+        await asyncio.sleep(0.01)
+    for name in asgi_server.GOOGLE_ENDPOINTS:
+        asgi_server.GOOGLE_ENDPOINTS[name] = 'http://127.0.0.1:%d/%s' % (port, name)
+
+    timings, failures = [], []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async def limited(client, user):
+        async with semaphore:
+            await simulateUser(client, asgi_server, user, timings, failures)
+
+    threads = threading.active_count()
+    try:
+        async with asgi_server.lifespan(asgi_server.app):
+            transport = httpx.ASGITransport(app=asgi_server.app)
+            async with httpx.AsyncClient(transport=transport,
+                                         base_url='http://icgdb.test') as client:
+                start = time.perf_counter()
+                await asyncio.gather(*[limited(client, user)
+                                       for user in range(args.users)])
+                elapsed = time.perf_counter() - start
+    finally:
+        stub.should_exit = True
+        await stub_task
+
+    timings.sort()
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+    print('%d users (%d at a time), stub latency %.0f ms, 4 Google calls each'
+          % (args.users, args.concurrency, args.latency * 1000))
+    print('  %d requests in %.2fs: %.1f requests/sec'
+          % (len(timings), elapsed, len(timings) / elapsed))
+    if timings:
+        print('  latency p50 %.0f ms, p95 %.0f ms, p99 %.0f ms, max %.0f ms'
+              % (percentile(0.5), percentile(0.95), percentile(0.99),
+                 timings[-1] * 1000))
+    print('  threads: %d before, %d after' % (threads, threading.active_count()))
+    print('  failures: %d' % len(failures))
+    for failure in failures[:5]:
+        print('    %s -> %s %s' % failure)
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load-test the async OAuth endpoints of asgi_server.py '
+                    'against a local stub of Google.')
+    parser.add_argument('--users', type=int, default=USERS,
+                        help='number of simulated users')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help='users logging in at the same time')
+    parser.add_argument('--latency', type=float, default=LATENCY,
+                        help='seconds the stub waits before each answer')
+    parser.add_argument('--database',
+                        help='SQLAlchemy database URL the users are written '
+                             'to (default: a scratch SQLite file)')
+    args = parser.parse_args(argv)
+
+    # must be set before asgi_server (and icgdb_database_setup) is imported,
+    # as DATABASE_URL and the session key are read at import time
+    os.environ.setdefault('ICGDB_SECRET_KEY', secrets.token_hex(16))
+    if args.database:
+        os.environ['ICGDB_DATABASE_URL'] = args.database
+    else:
+        scratch = tempfile.mkdtemp(prefix='icgdb-loadtest-')
+        os.environ['ICGDB_DATABASE_URL'] = 'sqlite:///%s' % os.path.join(
+            scratch, 'icgdb.db')
+    return asyncio.run(runLoadTest(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""Shared setup of the ICGDB tests.
+
+The modules under test read their database URL and client_secrets.json when
+they are imported, so a scratch SQLite database and a dummy
+client_secrets.json are set up here before any test imports them.
+"""
+import json
+import os
+import sys
+import tempfile
+from datetime import date
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRATCH = tempfile.mkdtemp(prefix='icgdb-tests-')
+os.environ['ICGDB_DATABASE_URL'] = 'sqlite:///%s' % os.path.join(SCRATCH, 'icgdb.db')
+sys.path.insert(0, ROOT)
+
+with open(os.path.join(SCRATCH, 'client_secrets.json'), 'w') as f:
+    json.dump({'web': {'client_id': 'icgdb-tests'}}, f)
+cwd = os.getcwd()
+os.chdir(SCRATCH) # flask_server reads client_secrets.json from the cwd
+try:
+    from sqlalchemy.orm import sessionmaker
+    from icgdb_database_setup import Game, Genre, Publisher, upgradeDatabase
+    import flask_server
+finally:
+    os.chdir(cwd)
+
+flask_server.app.secret_key = 'icgdb-tests'
+upgradeDatabase(flask_server.engine)
+
+
+def addGames(count, genre='RTS', publisher='Blizzard'):
+    """Adds count games of a genre and publisher, creating those if needed.
+
+    Returns:
+        The names of the new games.
+    """
+    db = sessionmaker(bind=flask_server.engine)()
+    try:
+        genre_obj = db.query(Genre).filter_by(name=genre).first() or \
+            Genre(name=genre, description='A genre.')
+        pub_obj = db.query(Publisher).filter_by(name=publisher).first() or \
+            Publisher(name=publisher, description='A publisher.')
+        first = db.query(Game).count()
+        names = ['Game %06d' % n for n in range(first, first + count)]
+        db.add_all(Game(name=name, genre=genre_obj, publisher=pub_obj,
+                        release_date=date(2000 + n % 20, 1 + n % 12, 1),
+                        description='A game.', rating='%d/100' % (n % 100),
+                        market_value='$%d' % (n % 60), pic_url='sc2wol.jpg')
+                   for n, name in enumerate(names, first))
+        db.commit()
+        return names
+    finally:
+        db.close()
+
+def clearCaches():
+    """Makes the next request read everything from the database again."""
+    flask_server.clearPageCache()
+    with flask_server.name_cache_lock:
+        flask_server.name_cache.clear()
+    with flask_server.catalog_version_lock:
+        flask_server.catalog_version['expires'] = 0.0
+
+
+@pytest.fixture
+def client():
+    """A Flask test client of the web app."""
+    return flask_server.app.test_client()
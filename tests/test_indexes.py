@@ -0,0 +1,58 @@
+"""The hot queries of the web app are answered from indexes, checked with
+SQLite's EXPLAIN QUERY PLAN."""
+import pytest
+from sqlalchemy import select, func, text
+
+import flask_server
+from flask_server import queryGames
+from icgdb_database_setup import Game, Genre, Publisher
+
+# (query, the index it must search)
+HOT_QUERIES = {
+    'game by name': (
+        lambda: queryGames().filter(Game.name == 'Game 000001').statement,
+        'ix_game_name'),
+    'genre page': (
+        lambda: queryGames().filter(Game.genre_id == 1).order_by(Game.name).statement,
+        'ix_game_genre_id_name'),
+    'publisher page': (
+        lambda: queryGames().filter(Game.publisher_id == 1).order_by(Game.name).statement,
+        'ix_game_publisher_id_name'),
+    'games of a user': (
+        lambda: select(Game.id).where(Game.user_email == 'someone@example.com'),
+        'ix_game_user_email'),
+    'games to move off a genre': (
+        lambda: select(Game.id).where(Game.genre_id == 1).limit(1000),
+        'ix_game_genre_id_'),
+    'latest release of a genre': (
+        lambda: select(func.max(Game.release_date)).where(Game.genre_id == 1),
+        'ix_game_genre_id_release_date'),
+    'picture still used': (
+        lambda: select(Game.id).where(Game.pic_url == 'x.png').limit(1),
+        'ix_game_pic_url'),
+    'genre by name': (
+        lambda: select(Genre).where(Genre.name == 'RTS'),
+        'sqlite_autoindex_genre_'),
+    'publisher by name': (
+        lambda: select(Publisher).where(Publisher.name == 'Blizzard'),
+        'sqlite_autoindex_publisher_'),
+}
+
+
+def queryPlan(statement):
+    """Returns the detail lines of SQLite's EXPLAIN QUERY PLAN of a statement."""
+    sql = str(statement.compile(flask_server.engine,
+                                compile_kwargs={'literal_binds': True}))
+    with flask_server.engine.connect() as conn:
+        return [row[-1] for row in conn.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_hot_query_uses_index(name):
+    make_statement, index = HOT_QUERIES[name]
+    plan = queryPlan(make_statement())
+    table = plan[0].split()[1]
+    assert plan[0].startswith('SEARCH %s USING ' % table), plan
+    assert ' INDEX %s' % index in plan[0], plan
+    assert not any(line.startswith('SCAN') for line in plan), plan
+    assert not any('TEMP B-TREE' in line for line in plan), plan # no sorting
@@ -0,0 +1,94 @@
+"""SQLite connections run in WAL mode, so readers work alongside a writer and
+writers wait for each other instead of failing with 'database is locked'."""
+import threading
+
+from sqlalchemy import select, func
+
+from icgdb_database_setup import Genre, SQLITE_PRAGMAS, makeEngine
+
+READERS = 4
+WRITES = 50
+
+
+def countGenres(conn):
+    return conn.execute(select(func.count()).select_from(Genre.__table__)).scalar()
+
+def addGenre(engine, name):
+    with engine.begin() as conn:
+        conn.execute(Genre.__table__.insert().values(name=name, description='x'))
+
+def runThreads(targets):
+    """Runs the functions in parallel threads and returns their exceptions."""
+    errors = []
+    def run(target):
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_connections_get_the_pragmas():
+    engine = makeEngine()
+    with engine.connect() as conn:
+        for name, expected in (('journal_mode', 'wal'), ('synchronous', 1),
+                               ('busy_timeout', int(SQLITE_PRAGMAS['busy_timeout'])),
+                               ('temp_store', 2)):
+            assert conn.exec_driver_sql('PRAGMA %s' % name).scalar() == expected
+    engine.dispose()
+
+def test_open_read_does_not_block_a_commit():
+    engine = makeEngine()
+    with engine.connect() as reader:
+        reader.exec_driver_sql('BEGIN') # pysqlite does not open one for SELECTs
+        before = countGenres(reader)
+        addGenre(engine, 'Committed during a read') # needs no wait in WAL mode
+        assert countGenres(reader) == before # the reader keeps its snapshot
+        reader.rollback()
+        assert countGenres(reader) == before + 1
+    engine.dispose()
+
+def test_parallel_readers_and_a_writer():
+    engine = makeEngine(pool_size=READERS + 1)
+    with engine.connect() as conn:
+        start = countGenres(conn)
+    done = threading.Event()
+    seen = [[] for _ in range(READERS)]
+
+    def read(counts):
+        while not done.is_set():
+            with engine.connect() as conn:
+                counts.append(countGenres(conn))
+    def write():
+        try:
+            for n in range(WRITES):
+                addGenre(engine, 'Concurrent %d' % n)
+        finally:
+            done.set()
+
+    errors = runThreads([write] + [lambda c=c: read(c) for c in seen])
+    assert errors == []
+    for counts in seen:
+        assert counts and counts == sorted(counts) # never goes back in time
+        assert start <= counts[0] and counts[-1] <= start + WRITES
+    with engine.connect() as conn:
+        assert countGenres(conn) == start + WRITES
+    engine.dispose()
+
+def test_concurrent_writers_wait_for_each_other():
+    engine = makeEngine()
+    with engine.connect() as conn:
+        start = countGenres(conn)
+    def write(prefix):
+        for n in range(WRITES):
+            addGenre(engine, '%s %d' % (prefix, n))
+    errors = runThreads([lambda p=p: write(p) for p in ('Writer A', 'Writer B')])
+    assert errors == [] # no 'database is locked'
+    with engine.connect() as conn:
+        assert countGenres(conn) == start + 2 * WRITES
+    engine.dispose()
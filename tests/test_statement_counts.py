@@ -0,0 +1,48 @@
+"""The list endpoints run a fixed number of SQL statements, however many games
+they return (no lazy loads per game)."""
+import pytest
+from sqlalchemy import event
+
+import flask_server
+from conftest import addGames, clearCaches
+
+URLS = [
+    '/main/games',
+    '/main/games?sort=rating&min_rating=10',
+    '/main/games/JSON',
+    '/main/games/JSON?sort=price&limit=100',
+    '/main/games/JSON?stream=ndjson',
+    '/main/games/XML',
+    '/main/genres/JSON',
+    '/main/publishers/JSON',
+    '/main/genres/RTS/',
+    '/main/publishers/Blizzard/',
+    '/main/genres/stats/JSON',
+]
+
+
+def countStatements(client, url):
+    """Returns the number of SQL statements a GET request runs."""
+    clearCaches()
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(flask_server.engine, 'before_cursor_execute', count)
+    try:
+        response = client.get(url)
+        response.get_data() # runs streamed responses to the end
+    finally:
+        event.remove(flask_server.engine, 'before_cursor_execute', count)
+    assert response.status_code == 200, url
+    return len(statements)
+
+
+@pytest.mark.parametrize('url', URLS)
+def test_statement_count_does_not_grow_with_games(client, url):
+    addGames(5)
+    few = countStatements(client, url)
+    # many publishers, so that lazy loads could not be served from the session
+    for n in range(30):
+        addGames(10, publisher='Publisher %02d' % n)
+    many = countStatements(client, url)
+    assert many == few